@@ -5,15 +5,299 @@ import plotly.graph_objects as go
 from datetime import datetime
 from pandas.tseries.offsets import DateOffset
 import time
+import os
+import re
+import shutil
+import platform
+import hashlib
+import zlib
+import pickle
+import json
+import io
+import threading
+from urllib.parse import quote
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 
 st.set_page_config(page_title="A350 Dashboard with COA POST Count", layout="wide")
 
 # -------------------------------
 # データ読み込み関数
 # -------------------------------
-@st.cache_data
-def load_defect_data():
-    df = pd.read_excel("Defects_by_Date.xlsx")
+DEFECT_FILE = "Defects_by_Date.xlsx"
+IRREGULAR_FILE = "AIBTYO DLI.xlsx"
+FC_FILE = "FHFC(Airbus).xlsx"
+
+# ファイルの更新時刻・サイズ（キャッシュキーとして使う）
+def get_file_version(path):
+    stat = os.stat(path)
+    return f"{stat.st_mtime_ns}-{stat.st_size}"
+
+# -------------------------------
+# 機種レジストリ（機番パターン → 機種、表示色）
+# -------------------------------
+FLEET_TYPES = {
+    "A350-900": {"tail_pattern": r"JA(0[1-9]|1[0-6])XJ", "color": "royalblue"},
+    "A350-1000": {"tail_pattern": r"JA(0[1-9]|10)WJ", "color": "crimson"},
+}
+FLEET_TYPE_NAMES = list(FLEET_TYPES)
+FLEET_OTHER = "その他"
+FLEET_GRID_COLUMNS = 2
+
+# 機番 → 機種（レジストリ先頭のパターンを優先）
+def classify_aircraft_type(tails):
+    tails = tails.astype(str)
+    aircraft_type = pd.Series(FLEET_OTHER, index=tails.index, dtype=object)
+    for name in reversed(FLEET_TYPE_NAMES):
+        aircraft_type[tails.str.fullmatch(FLEET_TYPES[name]["tail_pattern"])] = name
+    return aircraft_type
+
+# 1回の groupby で機種ごとに分割（該当なしの機種は空フレーム）
+def split_by_type(frame):
+    groups = dict(tuple(frame.groupby("Aircraft_Type", sort=False)))
+    return {name: groups.get(name, frame.iloc[:0]) for name in FLEET_TYPE_NAMES}
+
+# 機種数に応じた列グリッド（FLEET_GRID_COLUMNS 列で折り返し）
+def fleet_columns():
+    cells = []
+    for _ in range(0, len(FLEET_TYPE_NAMES), FLEET_GRID_COLUMNS):
+        cells.extend(st.columns(FLEET_GRID_COLUMNS))
+    return list(zip(FLEET_TYPE_NAMES, cells))
+
+def get_data_version(*paths):
+    key = "|".join(get_file_version(p) for p in paths)
+    return hashlib.sha1(key.encode("utf-8")).hexdigest()[:12]
+
+# 集計コードの版（このファイルの内容）。ディスクに残した集計はデータ版とこの版の両方で引く
+def get_code_version():
+    with open(__file__, "rb") as f:
+        return hashlib.sha1(f.read()).hexdigest()[:12]
+
+CODE_VERSION = get_code_version()
+
+# ディスクに永続化するキャッシュの関数ごとの上限（データ版・コード版が変わるたびに古い版を追い出す）
+DISK_CACHE_MAX_ENTRIES = 8
+
+# -------------------------------
+# 集計状態のスナップショット（プロセス内の増分計算の状態を再起動後も引き継ぐ）
+# -------------------------------
+STATE_SNAPSHOT_DIR = os.path.join(".cache", "state")
+
+def load_state_snapshot(name):
+    path = os.path.join(STATE_SNAPSHOT_DIR, f"{name}.pkl")
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return {}
+    return snapshot["state"] if snapshot.get("code_version") == CODE_VERSION else {}
+
+def save_state_snapshot(name, state):
+    os.makedirs(STATE_SNAPSHOT_DIR, exist_ok=True)
+    path = os.path.join(STATE_SNAPSHOT_DIR, f"{name}.pkl")
+    with open(path + ".tmp", "wb") as f:
+        pickle.dump({"code_version": CODE_VERSION, "state": state}, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + ".tmp", path)
+
+# -------------------------------
+# 不具合内容（MOD_Description）の表記ゆれクラスタリング（MinHash / LSH）
+# -------------------------------
+MOD_CLUSTER_DIR = os.path.join(".cache", "mod_clusters")
+MINHASH_PERMUTATIONS = 64
+LSH_BANDS = 16  # 16バンド × 4行（推定 Jaccard 0.5 付近から候補化）
+MOD_CLUSTER_THRESHOLD = 0.75
+MINHASH_PRIME = (1 << 31) - 1
+# 左右・前後・番号（エンジン番号・座席番号など）を表す語。これが異なる表記同士は結合しない
+MOD_POSITION_TOKEN = re.compile(
+    r"^(LH|RH|L|R|LEFT|RIGHT|FWD|AFT|CTR|CENTER|CENTRE|UPR|UPPER|LWR|LOWER|INBD|OUTBD|FRONT|REAR|NOSE|MAIN)$|\d"
+)
+
+# 大文字化し、記号を空白にそろえる（語の区切りは残す）
+def normalize_mod_description(series):
+    return (
+        series.astype(str).str.upper()
+        .str.replace(r"[\W_]+", " ", regex=True)
+        .str.strip()
+    )
+
+# 位置・番号を表す語の組（結合してよいのはこれが一致する表記同士だけ）
+def mod_position_keys(texts):
+    keys = [" ".join(sorted(t for t in text.split() if MOD_POSITION_TOKEN.search(t))) for text in texts]
+    return pd.factorize(pd.Series(keys, dtype=object))[0]
+
+def minhash_signatures(texts, batch_size=2000):
+    rng = np.random.default_rng(0)
+    a = rng.integers(1, MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+    b = rng.integers(0, MINHASH_PRIME, size=MINHASH_PERMUTATIONS, dtype=np.uint64)
+    signatures = np.empty((len(texts), MINHASH_PERMUTATIONS), dtype=np.uint64)
+
+    for start in range(0, len(texts), batch_size):
+        # 語ごとの文字3-gram（語の前後に区切りを付ける）を crc32 で整数化し、
+        # 説明ごとに (a*x + b) mod p の最小値を取る
+        counts, shingles = [], []
+        for text in texts[start:start + batch_size]:
+            grams = {
+                token[i:i + 3]
+                for token in (f" {t} " for t in text.split() or [""])
+                for i in range(max(len(token) - 2, 1))
+            }
+            counts.append(len(grams))
+            shingles.extend(zlib.crc32(g.encode("utf-8")) for g in grams)
+        x = np.asarray(shingles, dtype=np.uint64)[:, None]
+        hashed = (x * a + b) % MINHASH_PRIME
+        offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        signatures[start:start + len(counts)] = np.minimum.reduceat(hashed, offsets, axis=0)
+    return signatures
+
+def lsh_cluster(signatures, position_keys):
+    n = len(signatures)
+    parent = np.arange(n)
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    rows_per_band = MINHASH_PERMUTATIONS // LSH_BANDS
+    for band in range(LSH_BANDS):
+        band_sig = signatures[:, band * rows_per_band:(band + 1) * rows_per_band]
+        _, bucket = np.unique(band_sig, axis=0, return_inverse=True)
+        bucket = bucket.ravel()
+        order = np.argsort(bucket, kind="stable")
+        sorted_bucket = bucket[order]
+        first = order[np.searchsorted(sorted_bucket, sorted_bucket, side="left")]
+
+        # 同じバケットの先頭要素と、位置・番号の語が一致し推定 Jaccard が閾値以上のときだけ結合
+        candidates = order[first != order]
+        heads = first[first != order]
+        similarity = (signatures[candidates] == signatures[heads]).mean(axis=1)
+        merge = (similarity >= MOD_CLUSTER_THRESHOLD) & (position_keys[candidates] == position_keys[heads])
+        for i, j in zip(candidates[merge], heads[merge]):
+            root_i, root_j = find(i), find(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+
+    return np.array([find(i) for i in range(n)])
+
+# 説明文 → クラスタ代表名（件数最多の表記）。defect ファイル版・コード版（手法・パラメータ）ごとに保存して再利用
+def load_mod_clusters(descriptions, file_version):
+    cache_key = f"{file_version}-{CODE_VERSION}"
+    path = os.path.join(MOD_CLUSTER_DIR, hashlib.sha1(cache_key.encode("utf-8")).hexdigest()[:12] + ".parquet")
+    if os.path.exists(path):
+        mapping = pd.read_parquet(path)
+    else:
+        counts = descriptions.dropna().astype(str).value_counts()
+        unique = pd.DataFrame({"MOD_Description": counts.index, "Count": counts.values})
+        unique["Normalized"] = normalize_mod_description(unique["MOD_Description"])
+
+        normalized = unique.groupby("Normalized", sort=False)["Count"].sum()
+        texts = normalized.index.tolist()
+        cluster_root = lsh_cluster(minhash_signatures(texts), mod_position_keys(texts))
+        unique["MOD_Cluster_ID"] = pd.Series(cluster_root, index=normalized.index).reindex(unique["Normalized"]).to_numpy()
+
+        # 件数降順に並んでいるので各クラスタ先頭が代表表記
+        representative = unique.drop_duplicates("MOD_Cluster_ID").set_index("MOD_Cluster_ID")["MOD_Description"]
+        unique["MOD_Cluster"] = unique["MOD_Cluster_ID"].map(representative)
+        mapping = unique[["MOD_Description", "MOD_Cluster_ID", "MOD_Cluster"]]
+
+        os.makedirs(MOD_CLUSTER_DIR, exist_ok=True)
+        for name in os.listdir(MOD_CLUSTER_DIR):
+            os.remove(os.path.join(MOD_CLUSTER_DIR, name))
+        mapping.to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+    return mapping.set_index("MOD_Description")["MOD_Cluster"]
+
+# -------------------------------
+# 入力スキーマ（列ごとの型・日付書式・必須）と取り込み除外（quarantine）
+# -------------------------------
+DEFECT_SCHEMA = {
+    "Reported_Date": {
+        "type": "datetime",
+        "formats": ["%Y-%m-%d %H:%M:%S", "%Y-%m-%d", "%Y/%m/%d", "%d-%b-%Y"],
+        "required": True,
+    },
+    "Tail": {"type": "text", "required": True},
+    # 551.0 のような浮動小数や "0551" のような文字列も取り込み、章・サブチャプターは数値化してから4桁にそろえる
+    "ATA": {"type": "code"},
+}
+IRREGULAR_SCHEMA = {
+    "Date": {"type": "datetime", "formats": ["%d-%b-%Y"], "required": True},
+    "Tail": {"type": "text", "required": True},
+    # 数値・"0551" のような文字列が混在するため、値はそのまま残し数字かどうかだけ検査する
+    "ATA_SubChapter": {"type": "code"},
+}
+FC_SCHEMA = {
+    "Tail": {"type": "text", "required": True},
+    "FC": {"type": "number", "required": True},
+}
+SCHEMA_INVALID_REASONS = {
+    "datetime": "日付として解釈できない",
+    "number": "数値として解釈できない",
+    "code": "数字コードとして解釈できない",
+}
+QUARANTINE_COLUMNS = ["Source", "Row", "Column", "Reason", "Value", "Action"]
+
+# 明示した書式を順に当てる（書式ごとに未解釈の行だけをまとめて変換）
+def parse_datetime_column(values, formats):
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    parsed = pd.Series(pd.NaT, index=values.index, dtype="datetime64[ns]")
+    for fmt in formats:
+        todo = parsed.isna() & values.notna()
+        if not todo.any():
+            break
+        parsed[todo] = pd.to_datetime(values[todo], format=fmt, errors="coerce")
+    return parsed
+
+def empty_quarantine():
+    return pd.DataFrame(columns=QUARANTINE_COLUMNS)
+
+# スキーマの列を型変換し、必須列が空・変換できない行を除外して quarantine に記録する
+# （任意列で変換できない値は欠損として取り込み、同じく記録する）
+def apply_schema(frame, schema, source, row_numbers):
+    row_numbers = np.asarray(row_numbers)
+    rejected = np.zeros(len(frame), dtype=bool)
+    issues = []
+    for col, spec in schema.items():
+        raw = frame[col]
+        present = (raw.notna() & (raw.astype(str).str.strip() != "")).to_numpy()
+        if spec["type"] == "datetime":
+            value = parse_datetime_column(raw, spec["formats"])
+        elif spec["type"] == "number":
+            value = pd.to_numeric(raw, errors="coerce")
+        elif spec["type"] == "code":
+            # 整数として読める値だけを有効にする（2151.5 のような小数は不可）
+            code = pd.to_numeric(raw, errors="coerce")
+            value = raw.where(code.notna() & (code % 1 == 0))
+        else:
+            value = raw.where(present)
+
+        required = spec.get("required", False)
+        invalid = present & value.isna().to_numpy()
+        missing = ~present if required else np.zeros(len(frame), dtype=bool)
+        for mask, reason in ((invalid, SCHEMA_INVALID_REASONS.get(spec["type"])), (missing, "必須項目が空")):
+            if mask.any():
+                issues.append(pd.DataFrame({
+                    "Source": source,
+                    "Row": row_numbers[mask].astype(str),
+                    "Column": col,
+                    "Reason": reason,
+                    "Value": raw[mask].astype(str).to_numpy(),
+                    "Action": "行を除外" if required else "欠損として取り込み",
+                }))
+        if required:
+            rejected |= invalid | missing
+        frame[col] = value
+
+    quarantine = pd.concat(issues, ignore_index=True) if issues else empty_quarantine()
+    return frame[~rejected], quarantine
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def load_defect_data(file_version):
+    df = pd.read_excel(DEFECT_FILE)
     df = df.rename(columns={
         'Tail': 'Tail',
         'Reported Date': 'Reported_Date',
@@ -22,57 +306,129 @@ def load_defect_data():
         'P/N': 'PN',
         'Corrective Action': 'Corrective_Action'
     })
-    df['Reported_Date'] = pd.to_datetime(df['Reported_Date'], errors='coerce')
-    df.dropna(subset=['Reported_Date'], inplace=True)
+    # Excel の行番号（1行目が見出し）
+    df, quarantine = apply_schema(df, DEFECT_SCHEMA, "defects", df.index + 2)
     df['Reported_Date_Str'] = df['Reported_Date'].dt.strftime('%Y-%m-%d')
     df['Reported_Date_Only'] = df['Reported_Date'].dt.date
-    df['YearMonth'] = pd.to_datetime(df['Reported_Date'], errors='coerce').dt.to_period('M').astype(str)
-    df['ATA_Chapter'] = df['ATA'].astype(str).str.zfill(4).str[:2]
-    df['ATA_SubChapter'] = df['ATA'].astype(str).str.zfill(4).str[:4]
-    df['Aircraft_Type'] = df['Tail'].apply(lambda x:
-        'A350-900' if x in [f"JA{str(i).zfill(2)}XJ" for i in range(1, 17)] else (
-        'A350-1000' if x in [f"JA{str(i).zfill(2)}WJ" for i in range(1, 11)] else 'その他'))
-    return df
-
-@st.cache_data
-def load_irregular_data():
-    # データ存在行をすべて読み込む（空白行含む）
-    df_ir = pd.read_excel(
-        "AIBTYO DLI.xlsx",
-        sheet_name="EVENTS",
-        skiprows=2,  # 3行目から読み込み（header=2と同じ効果）
-        usecols="A,B,D,E,H,I,J,K,L,M,P,Q,S,T,V,W,Y"
-    )
-
-    df_ir.columns = [
-        "FLT_Number", "Date", "Tail", "Branch",
-        "Delay_Flag", "Delay_Time",
-        "Cancel_Flag", "ShipChange_Flag", "RTO_Flag", "ATB_Flag",
-        "Diversion_Flag", "EngShutDown_Flag", "Description", "Work_Performed",
-        "ATA_SubChapter","Delay_Code", "Total_Maintenance_DownTime"
-    ]
-
-    # Date列を日付型に変換
-    df_ir["Date"] = pd.to_datetime(df_ir["Date"], format="%d-%b-%Y", errors="coerce")
-
-    # 空行削除（TailやDateがない行は不要）
-    df_ir.dropna(subset=["Date", "Tail"], how="any", inplace=True)
+    df['YearMonth'] = df['Reported_Date'].dt.to_period('M').astype(str)
+    ata_num = pd.to_numeric(df['ATA'], errors='coerce')
+    ata_code = ata_num.astype('Int64').astype(str).str.zfill(4)
+    df['ATA_Chapter'] = ata_code.str[:2].where(ata_num.notna())
+    df['ATA_SubChapter'] = ata_code.str[:4].where(ata_num.notna())
+    df['Aircraft_Type'] = classify_aircraft_type(df['Tail'])
+
+    # 表記ゆれをまとめた不具合内容（クラスタ代表名）
+    mod_clusters = load_mod_clusters(df['MOD_Description'], file_version)
+    df['MOD_Cluster'] = df['MOD_Description'].astype(str).map(mod_clusters).where(df['MOD_Description'].notna())
+    return df, quarantine
+
+# EVENTS シート：1行目が表題、2行目が見出し、3行目からデータ（先頭が最新）。必要な列だけを列記号で指定
+IRREGULAR_SHEET = "EVENTS"
+IRREGULAR_HEADER_ROW = 2
+IRREGULAR_FIRST_DATA_ROW = 3
+# 見出しの確認用（レイアウトが変わったら読み込みを止める）
+IRREGULAR_EXPECTED_HEADERS = {"A": "Flight Number", "B": "Event Date", "D": "Registration"}
+IRREGULAR_COLUMNS = {
+    "A": "FLT_Number", "B": "Date", "D": "Tail", "E": "Branch",
+    "H": "Delay_Flag", "I": "Delay_Time",
+    "J": "Cancel_Flag", "K": "ShipChange_Flag", "L": "RTO_Flag", "M": "ATB_Flag",
+    "P": "Diversion_Flag", "Q": "EngShutDown_Flag", "S": "Description", "T": "Work_Performed",
+    "V": "ATA_SubChapter", "W": "Delay_Code", "Y": "Total_Maintenance_DownTime",
+}
+IRREGULAR_BATCH_ROWS = 5000
+IRREGULAR_BLANK_RUN = 100  # 書式だけの空行がこの行数続いたらデータ終端とみなす
+EXCEL_NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null",
+}
+
+# 1バッチ分の行をスキーマで型変換（行番号＝Excel の行番号をインデックスにする）
+def to_irregular_batch(rows, row_numbers):
+    batch = pd.DataFrame(rows, columns=list(IRREGULAR_COLUMNS.values()), index=row_numbers)
+    # pandas.read_excel と同じく "NA" などの文字列は欠損扱い
+    batch = batch.astype(object)
+    batch = batch.mask(batch.isna() | batch.isin(list(EXCEL_NA_VALUES)), np.nan).infer_objects()
+    return apply_schema(batch, IRREGULAR_SCHEMA, "irregular", batch.index)
+
+# 読み取り専用モードで1行ずつ読み、必要な列だけ取り出して IRREGULAR_BATCH_ROWS 行ごとに
+# (型変換済みの行, 除外行) を返す
+def iter_irregular_batches(path):
+    from openpyxl import load_workbook
+    from openpyxl.utils import column_index_from_string
+
+    positions = [column_index_from_string(c) - 1 for c in IRREGULAR_COLUMNS]
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        ws = wb[IRREGULAR_SHEET]
+        header = next(ws.iter_rows(min_row=IRREGULAR_HEADER_ROW, max_row=IRREGULAR_HEADER_ROW, values_only=True))
+        for letter, expected in IRREGULAR_EXPECTED_HEADERS.items():
+            actual = header[column_index_from_string(letter) - 1]
+            if str(actual).strip() != expected:
+                raise ValueError(
+                    f"{IRREGULAR_SHEET} シート {letter}{IRREGULAR_HEADER_ROW} の見出しが '{expected}' ではありません（'{actual}'）。"
+                )
+
+        rows, row_numbers, blank_run, stopped_at = [], [], 0, None
+        rows_iter = ws.iter_rows(min_row=IRREGULAR_FIRST_DATA_ROW, max_col=max(positions) + 1, values_only=True)
+        for row_number, row in enumerate(rows_iter, start=IRREGULAR_FIRST_DATA_ROW):
+            values = [row[i] if i < len(row) else None for i in positions]
+            if all(v is None or (isinstance(v, str) and not v.strip()) for v in values):
+                blank_run += 1
+                if blank_run >= IRREGULAR_BLANK_RUN:
+                    stopped_at = row_number
+                    break
+                continue
+            blank_run = 0
+            rows.append(values)
+            row_numbers.append(row_number)
+            if len(rows) >= IRREGULAR_BATCH_ROWS:
+                yield to_irregular_batch(rows, row_numbers)
+                rows, row_numbers = [], []
+        if rows:
+            yield to_irregular_batch(rows, row_numbers)
+
+        # 空行の連続で打ち切った後にもシート上の行が残っていれば、読まなかった範囲を除外行として残す
+        if stopped_at is not None and (ws.max_row is None or ws.max_row > stopped_at):
+            unread = f"{stopped_at + 1}行目以降" if ws.max_row is None else f"{stopped_at + 1}〜{ws.max_row}行目"
+            yield to_irregular_batch([], [])[0], pd.DataFrame([{
+                "Source": "irregular",
+                "Row": str(stopped_at + 1),
+                "Column": "",
+                "Reason": f"空行が {IRREGULAR_BLANK_RUN} 行続いたためデータ終端とみなした",
+                "Value": unread,
+                "Action": "以降の行を読み込まず",
+            }], columns=QUARANTINE_COLUMNS)
+    finally:
+        wb.close()
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def load_irregular_data(file_version):
+    # 空白行は読み飛ばし、終端以降の書式だけの行は読まない。Date・Tail が空の行は quarantine へ
+    batches = list(iter_irregular_batches(IRREGULAR_FILE))
+    if not batches:
+        batches = [to_irregular_batch([], [])]
+    # 行のないバッチ（打ち切り位置の記録だけのもの）は結合しない
+    df_ir = pd.concat([batch for batch, _ in batches if len(batch)] or [batches[0][0]])
+    quarantine = pd.concat([issues for _, issues in batches], ignore_index=True)
 
     # YearMonth列作成
     df_ir["YearMonth"] = df_ir["Date"].dt.to_period("M").astype(str)
 
+    # ATA_Chapter列作成（不具合データと同じ2桁）
+    ata_num = pd.to_numeric(df_ir["ATA_SubChapter"], errors="coerce")
+    df_ir["ATA_Chapter"] = ata_num.astype("Int64").astype(str).str.zfill(4).str[:2].where(ata_num.notna())
+
     # Aircraft_Type 判定
-    df_ir["Aircraft_Type"] = df_ir["Tail"].apply(lambda x:
-        "A350-900" if x in [f"JA{str(i).zfill(2)}XJ" for i in range(1, 17)] else (
-        "A350-1000" if x in [f"JA{str(i).zfill(2)}WJ" for i in range(1, 11)] else "その他")
-    )
+    df_ir["Aircraft_Type"] = classify_aircraft_type(df_ir["Tail"])
 
-    return df_ir
+    return df_ir, quarantine
 
 
 
-df = load_defect_data()
-df_irregular = load_irregular_data()
+df, defect_quarantine = load_defect_data(get_file_version(DEFECT_FILE))
+df_irregular, irregular_quarantine = load_irregular_data(get_file_version(IRREGULAR_FILE))
+# 入力ファイルの版 + 集計コードの版（集計キャッシュはこのキーでディスクにも保存する）
+DATA_VERSION = f"{get_data_version(DEFECT_FILE, IRREGULAR_FILE, FC_FILE)}-{CODE_VERSION}"
 
 # -------------------------------
 # 関数
@@ -86,63 +442,6 @@ def filter_cabin_related(df):
     mask2 = ~( (df['ATA_Chapter'] == '00') & df['MOD_Description'].str.lower().str.contains('seat') )
     return df[mask1 & mask2]
 
-# -------------------------------
-# 表示
-# -------------------------------
-st.title("A350 Monitoring Dashboard")
-
-latest_date = df['Reported_Date'].max()
-one_year_ago = latest_date - DateOffset(years=1)
-df_recent_1y = df[df['Reported_Date'] >= one_year_ago]
-
-# 不具合件数（機種別・月別）
-monthly_by_type = (
-    df_recent_1y.groupby(['YearMonth', 'Aircraft_Type'])
-    .size()
-    .reset_index(name='Defect_Count')
-    .pivot(index='YearMonth', columns='Aircraft_Type', values='Defect_Count')
-    .fillna(0)
-    .reset_index()
-)
-monthly_by_type['Defect_Total'] = monthly_by_type[['A350-900', 'A350-1000']].sum(axis=1)
-
-# 列名に "Defect_" プレフィックスを付ける
-monthly_by_type = monthly_by_type.rename(columns={
-    'A350-900': 'Defect_A350-900',
-    'A350-1000': 'Defect_A350-1000',
-    'Defect_Total': 'Defect_Total'
-})
-
-# イレギュラー件数（機種別・月別）
-monthly_irregular = (
-    df_irregular.groupby(['YearMonth', 'Aircraft_Type'])
-    .size()
-    .reset_index(name="Irreg_Count")
-    .pivot(index="YearMonth", columns="Aircraft_Type", values="Irreg_Count")
-    .fillna(0)
-    .reset_index()
-)
-monthly_irregular['Irreg_Total'] = monthly_irregular[['A350-900', 'A350-1000']].sum(axis=1)
-
-# 列名に "Irreg_" プレフィックスを付ける
-monthly_irregular = monthly_irregular.rename(columns={
-    'A350-900': 'Irreg_A350-900',
-    'A350-1000': 'Irreg_A350-1000',
-    'Irreg_Total': 'Irreg_Total'
-})
-
-# マージ（YearMonth をキーに結合）
-monthly_combined = pd.merge(monthly_by_type, monthly_irregular, on="YearMonth", how="outer").fillna(0)
-monthly_combined = monthly_combined.sort_values("YearMonth")
-
-
-# -------------------------------
-# 📊 月別推移グラフ（不具合 + イレギュラー）
-# -------------------------------
-st.subheader("📊 A350 Fleet Brief")
-
-filter_exclude_graph = st.checkbox("Seat/IFE/WiFiを除く（グラフ適用）")
-
 def filter_cabin_related_both(df_def, df_ir):
     exclude_patterns = ["2520", "2521", "2528"] + \
                        [f"442{i}" for i in range(10)] + \
@@ -160,83 +459,1327 @@ def filter_cabin_related_both(df_def, df_ir):
     
     return df_def[mask_def], df_ir[mask_ir]
 
+# イレギュラーの ATA は数値で入っているため、不具合と同じ4桁表記にそろえる
+def normalize_irregular_ata(df_ir):
+    ata_num = pd.to_numeric(df_ir["ATA_SubChapter"], errors="coerce").astype("Int64")
+    return df_ir.assign(ATA_SubChapter=ata_num.astype(str).str.zfill(4).where(ata_num.notna()))
 
-if filter_exclude_graph:
-    df_recent_1y_filtered, df_irregular_filtered = filter_cabin_related_both(df_recent_1y, df_irregular)
-else:
-    df_recent_1y_filtered, df_irregular_filtered = df_recent_1y, df_irregular
-
-# 不具合（月別）
-monthly_by_type = (
-    df_recent_1y_filtered.groupby(['YearMonth', 'Aircraft_Type'])
-    .size()
-    .reset_index(name='Defect_Count')
-    .pivot(index='YearMonth', columns='Aircraft_Type', values='Defect_Count')
-    .fillna(0)
-    .reset_index()
-)
-monthly_by_type['Defect_Total'] = monthly_by_type[['A350-900', 'A350-1000']].sum(axis=1)
-monthly_by_type = monthly_by_type.rename(columns={
-    'A350-900': 'Defect_A350-900',
-    'A350-1000': 'Defect_A350-1000'
-})
-
-# イレギュラー（月別）
-monthly_irregular = (
-    df_irregular_filtered.groupby(['YearMonth', 'Aircraft_Type'])
-    .size()
-    .reset_index(name="Irreg_Count")
-    .pivot(index="YearMonth", columns="Aircraft_Type", values="Irreg_Count")
-    .fillna(0)
-    .reset_index()
-)
-monthly_irregular['Irreg_Total'] = monthly_irregular[['A350-900', 'A350-1000']].sum(axis=1)
-monthly_irregular = monthly_irregular.rename(columns={
-    'A350-900': 'Irreg_A350-900',
-    'A350-1000': 'Irreg_A350-1000'
-})
-
-# マージ
-monthly_combined = pd.merge(monthly_by_type, monthly_irregular, on="YearMonth", how="outer").fillna(0)
-monthly_combined = monthly_combined.sort_values("YearMonth")
-
-# グラフ作成
-fig_total = go.Figure()
-# 折れ線（不具合）- 左軸
-for col in ["Defect_A350-900", "Defect_A350-1000", "Defect_Total"]:
-    fig_total.add_trace(go.Scatter(
+# 機種別・月別件数（全機種を1回の groupby で集計、列名に prefix を付ける）
+def monthly_counts_by_type(frame, prefix):
+    counts = (
+        frame.groupby(['YearMonth', 'Aircraft_Type'])
+        .size()
+        .unstack('Aircraft_Type', fill_value=0)
+        .reindex(columns=FLEET_TYPE_NAMES, fill_value=0)
+        .add_prefix(f"{prefix}_")
+    )
+    counts[f"{prefix}_Total"] = counts.sum(axis=1)
+    return counts.reset_index()
+
+# Fleet Brief 用：不具合・イレギュラーの機種別月別件数（exclude_cabin はキャッシュキー用）
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_monthly_combined(_df_def, _df_ir, data_version, exclude_cabin):
+    monthly_by_type = monthly_counts_by_type(_df_def, "Defect")
+    monthly_irregular = monthly_counts_by_type(_df_ir, "Irreg")
+    monthly_combined = pd.merge(monthly_by_type, monthly_irregular, on="YearMonth", how="outer").fillna(0)
+    return monthly_combined.sort_values("YearMonth")
+
+# 機種別・月別 Operational Reliability と全機種のイレギュラー件数
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_reliability_by_type(_df_ir, _df_fc, data_version):
+    irreg_by_type = (
+        _df_ir.groupby(["YearMonth", "Aircraft_Type"])
+        .size()
+        .reset_index(name="Irreg_Count")
+    )
+    fc_by_type = (
+        _df_fc.groupby(["YearMonth", "Aircraft_Type"], as_index=False)["FC"].sum()
+        .rename(columns={"FC": "Total_FC"})
+    )
+    rel_by_type = pd.merge(fc_by_type, irreg_by_type, on=["YearMonth", "Aircraft_Type"], how="left")
+    rel_by_type["Irreg_Count"] = rel_by_type["Irreg_Count"].fillna(0)
+
+    # Operational Reliability (%)（ゼロ除算対策）
+    rel_by_type["Operational_Reliability"] = np.where(
+        rel_by_type["Total_FC"] > 0,
+        ((rel_by_type["Total_FC"] - rel_by_type["Irreg_Count"]) / rel_by_type["Total_FC"]) * 100,
+        np.nan
+    )
+
+    irreg_total = (
+        _df_ir.groupby("YearMonth")
+        .size()
+        .reset_index(name="Irreg_Total")
+    )
+
+    rel_by_type["YearMonth_dt"] = pd.to_datetime(rel_by_type["YearMonth"], format="%Y-%m", errors="coerce")
+    irreg_total["YearMonth_dt"] = pd.to_datetime(irreg_total["YearMonth"], format="%Y-%m", errors="coerce")
+    return rel_by_type, irreg_total
+
+# 機種別の月間 FC と機番別 Operational Reliability を一括計算
+# （データ版ごとにキャッシュ。DataFrame 引数はハッシュ対象外）
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_fc_reliability(_df_ir, _df_fc, data_version):
+    # 機種別 FC（機種×月の合計。ATA別 FC比の分母）
+    fc_by_type = _df_fc.groupby(["Aircraft_Type", "YearMonth"])["FC"].sum().sort_index()
+
+    # 機番別 Operational Reliability（機番×月）
+    fc_by_tail = _df_fc.groupby(["Tail", "YearMonth"])["FC"].sum()
+    tail_rel = fc_by_tail.to_frame().join(
+        _df_ir.groupby(["Tail", "YearMonth"]).size().rename("Irreg_Count")
+    )
+    tail_rel["Irreg_Count"] = tail_rel["Irreg_Count"].fillna(0)
+    tail_rel["Operational_Reliability"] = np.where(
+        tail_rel["FC"] > 0,
+        (tail_rel["FC"] - tail_rel["Irreg_Count"]) / tail_rel["FC"] * 100,
+        np.nan
+    )
+    tail_rel_matrix = tail_rel["Operational_Reliability"].unstack("YearMonth").sort_index(axis=1)
+
+    return fc_by_type, tail_rel_matrix
+
+# ATA 増加率・警報：章/サブチャプター × 機種 × 月をまとめて計算
+ATA_ALERT_LEVELS = {"Chapter": "ATA_Chapter", "SubChapter": "ATA_SubChapter"}
+
+def build_ata_count_matrix(df, ata_col):
+    # 行＝暦月（欠損月は0）、列＝(機種, ATA) の系列
+    counts = (
+        df.groupby(["YearMonth", "Aircraft_Type", ata_col])
+        .size()
+        .unstack(["Aircraft_Type", ata_col], fill_value=0)
+        .sort_index(axis=1)
+    )
+    months = pd.period_range(counts.index.min(), counts.index.max(), freq="M").strftime("%Y-%m")
+    return counts.reindex(months, fill_value=0)
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_ata_alerts(_df, data_version, window=6, k=2.0):
+    frames = []
+    for level, ata_col in ATA_ALERT_LEVELS.items():
+        counts = build_ata_count_matrix(_df, ata_col)
+        prev = counts.shift(1)
+
+        # 短期：前月比、長期：6か月移動平均の前月比（前月0は0%扱い）
+        ma = counts.rolling(window=window, min_periods=2).mean()
+        prev_ma = ma.shift(1)
+        short_rate = ((counts - prev) / prev.where(prev > 0) * 100).fillna(0)
+        long_rate = ((ma - prev_ma) / prev_ma.where(prev_ma > 0) * 100).fillna(0)
+
+        # 警報レベル：当月を含まない直近 window か月の平均 + kσ
+        trailing = prev.rolling(window=window, min_periods=2)
+        trailing_mean = trailing.mean()
+        trailing_std = trailing.std()
+        alert_level = trailing_mean + k * trailing_std
+
+        n_months, n_series = counts.shape
+        series = counts.columns.to_frame(index=False)
+        frames.append(pd.DataFrame({
+            "Level": level,
+            "YearMonth": np.repeat(counts.index.values, n_series),
+            "Aircraft_Type": np.tile(series["Aircraft_Type"].values, n_months),
+            "ATA": np.tile(series[ata_col].astype(str).values, n_months),
+            "Count": counts.values.ravel(),
+            "MA": ma.values.ravel(),
+            "Alert_Level": alert_level.values.ravel(),
+            "Sigma": ((counts - trailing_mean) / trailing_std.where(trailing_std > 0)).values.ravel(),
+            "Short_Rate": short_rate.values.ravel(),
+            "Long_Rate": long_rate.values.ravel(),
+        }))
+
+    alerts = pd.concat(frames, ignore_index=True)
+    alerts["Exceeded"] = (alerts["Count"] > 0) & (alerts["Count"] > alerts["Alert_Level"])
+    return alerts.set_index(["Level", "YearMonth"]).sort_index()
+
+def lookup_ata_alerts(alerts, level, year_month):
+    if (level, year_month) not in alerts.index:
+        return alerts.iloc[0:0].reset_index()
+    return alerts.loc[[(level, year_month)]].reset_index()
+
+# -------------------------------
+# ATA 件数予測：全系列（機種 × ATA）を行列のまま EWMA 水準で一括推定し、ポアソン予測区間を付ける
+# -------------------------------
+FORECAST_SOURCES = {"不具合": "defects", "イレギュラー": "irregular"}
+FORECAST_HORIZON = 3
+FORECAST_ALPHA = 0.3
+FORECAST_INTERVAL = (0.05, 0.95)
+
+# 月ごとの EWMA 水準（行＝月、列＝系列）。前回と件数が同じ月までは前回の水準を再利用する
+def fit_ewma_levels(counts, prev=None):
+    values = counts.to_numpy(dtype=float)
+    levels = np.empty_like(values)
+    start = 0
+    if (
+        prev is not None
+        and len(prev["counts"]) <= len(counts)
+        and counts.index[:len(prev["counts"])].equals(prev["counts"].index)
+        and prev["counts"].columns.isin(counts.columns).all()
+    ):
+        n = len(prev["counts"])
+        old_counts = prev["counts"].reindex(columns=counts.columns, fill_value=0).to_numpy(dtype=float)
+        old_levels = prev["levels"].reindex(columns=counts.columns, fill_value=0).to_numpy(dtype=float)
+        changed = (old_counts != values[:n]).any(axis=1)
+        start = int(np.argmax(changed)) if changed.any() else n
+        levels[:start] = old_levels[:start]
+
+    level = levels[start - 1] if start > 0 else values[0]
+    for m in range(start, len(values)):
+        level = FORECAST_ALPHA * values[m] + (1 - FORECAST_ALPHA) * level
+        levels[m] = level
+    return pd.DataFrame(levels, index=counts.index, columns=counts.columns)
+
+# 各系列の平均 lam に対する下側 q 分位点（pmf の漸化式を系列方向にベクトル化）
+# pmf は対数で計算する（λ が 745 を超えると exp(-λ) が 0 にアンダーフローするため）
+def poisson_quantiles(lam, quantiles):
+    lam = np.asarray(lam, dtype=float)
+    k_max = int(np.ceil(lam.max() + 10 * np.sqrt(lam.max()) + 10)) if len(lam) else 0
+    k = np.arange(k_max + 1)
+    log_factorial = np.concatenate([[0.0], np.cumsum(np.log(k[1:]))])
+    with np.errstate(divide="ignore", invalid="ignore"):
+        log_lam = np.log(lam)[:, None]
+        # λ = 0 のときは k = 0 だけが確率 1
+        log_pmf = np.where(k == 0, 0.0, k * log_lam) - lam[:, None] - log_factorial
+    cdf = np.exp(log_pmf).cumsum(axis=1)
+    return [(cdf < q).sum(axis=1) for q in quantiles]
+
+def forecast_frames(df_def, df_ir):
+    return {"defects": df_def, "irregular": normalize_irregular_ata(df_ir)}
+
+# 前回の水準をプロセス内で保持し、新しい月（と件数が変わった月）以降だけ更新する
+@st.cache_resource
+def get_forecast_state():
+    return load_state_snapshot("forecast")
+
+@st.cache_resource
+def get_forecast_lock():
+    return threading.Lock()
+
+# 予測表と、予測に使った件数行列 {(source, level): counts} を返す（共有状態はロック内でのみ読み書き）
+def forecast_ata_counts(df_def, df_ir, data_version):
+    with get_forecast_lock():
+        forecasts = update_forecasts(df_def, df_ir, data_version)
+        state = get_forecast_state()
+        counts = {key: value["counts"] for key, value in state.items() if isinstance(key, tuple)}
+    return forecasts, counts
+
+def update_forecasts(df_def, df_ir, data_version):
+    state = get_forecast_state()
+    if state.get("data_version") == data_version:
+        return state["forecasts"]
+
+    frames = []
+    for source, frame in forecast_frames(df_def, df_ir).items():
+        for level, ata_col in ATA_ALERT_LEVELS.items():
+            counts = build_ata_count_matrix(frame.dropna(subset=[ata_col]), ata_col)
+            levels = fit_ewma_levels(counts, state.get((source, level)))
+            state[(source, level)] = {"counts": counts, "levels": levels}
+
+            expected = levels.iloc[-1].to_numpy()
+            lower, upper = poisson_quantiles(expected, FORECAST_INTERVAL)
+            last_month = pd.Period(counts.index[-1], freq="M")
+            series = counts.columns.to_frame(index=False)
+            for h in range(1, FORECAST_HORIZON + 1):
+                frames.append(pd.DataFrame({
+                    "Source": source,
+                    "Level": level,
+                    "Aircraft_Type": series["Aircraft_Type"].values,
+                    "ATA": series[ata_col].astype(str).values,
+                    "Horizon": h,
+                    "Forecast_Month": (last_month + h).strftime("%Y-%m"),
+                    "Last_Count": counts.iloc[-1].to_numpy(),
+                    "Expected": expected,
+                    "Lower": lower,
+                    "Upper": upper,
+                }))
+
+    forecasts = pd.concat(frames, ignore_index=True).set_index(["Source", "Level"]).sort_index()
+    state["data_version"] = data_version
+    state["forecasts"] = forecasts
+    save_state_snapshot("forecast", state)
+    return forecasts
+
+# 機番別の累積FCを日付ごとに推定（月次FCを累積し、月内は日割り）
+def estimate_cumulative_fc(df_fc, tails, dates):
+    fc = df_fc.groupby(["Tail", "YearMonth"])["FC"].sum().reset_index()
+    fc["Month_Start"] = pd.to_datetime(fc["YearMonth"], format="%Y-%m")
+    fc = fc.sort_values(["Tail", "Month_Start"])
+    fc["FC_Before"] = fc.groupby("Tail")["FC"].cumsum() - fc["FC"]
+
+    query = pd.DataFrame({
+        "Tail": np.asarray(tails),
+        "Month_Start": pd.DatetimeIndex(dates).to_period("M").to_timestamp(),
+    })
+    query = query.merge(fc[["Tail", "Month_Start", "FC", "FC_Before"]], on=["Tail", "Month_Start"], how="left")
+    dates = pd.DatetimeIndex(dates)
+    month_fraction = (dates.day - 1) / dates.days_in_month
+    return (query["FC_Before"] + query["FC"] * month_fraction).to_numpy()
+
+# ソート済みの (グループ, 値) 配列で、同一グループ内の直前 window 以内の件数を数える
+def count_in_window(group_codes, values, window):
+    values = np.asarray(values, dtype=float)
+    if len(values) == 0:
+        return np.zeros(0, dtype=int)
+    # グループ間の距離を値の幅＋window 以上にして 1 本のキーにする
+    offset = values - values.min()
+    keys = group_codes * (offset.max() + window + 1) + offset
+    return np.arange(len(keys)) - np.searchsorted(keys, keys - window, side="left")
+
+# -------------------------------
+# 履歴ストア（YearMonth パーティション、Arrow IPC）と SQL 分析
+# -------------------------------
+HISTORY_STORE_DIR = os.path.join(".cache", "history")
+HISTORY_TABLES = {"defects": "Reported_Date", "irregular": "Date", "fc": "Tail"}
+
+def to_columnar_frame(df):
+    # 文字列・日付以外が混在する object 列は文字列として保存
+    out = df.copy()
+    for col in out.columns:
+        if out[col].dtype == object and pd.api.types.infer_dtype(out[col]) not in ("string", "date", "empty"):
+            out[col] = out[col].astype("string")
+    return out
+
+# 月ごとに 1 ファイル（YearMonth=YYYY-MM/part-0.arrow）。内容が変わった月だけ書き直す。
+# マニフェストが同じ元ファイル・コード版で書かれていれば、再起動後も書き直さずにそのまま使う
+@st.cache_data
+def build_history_store(_frame, table, file_version):
+    import pyarrow as pa
+
+    path = os.path.join(HISTORY_STORE_DIR, table)
+    os.makedirs(path, exist_ok=True)
+    manifest_path = os.path.join(path, "_manifest.json")
+    manifest = {}
+    if os.path.exists(manifest_path):
+        with open(manifest_path, encoding="utf-8") as f:
+            manifest = json.load(f)
+
+    source_key = f"{file_version}-{CODE_VERSION}"
+    stored_months = [m for m in manifest if not m.startswith("_")]
+    if manifest.get("_source") == source_key and all(
+        os.path.exists(os.path.join(path, f"YearMonth={month}", "part-0.arrow")) for month in stored_months
+    ):
+        return path
+
+    frame = to_columnar_frame(_frame.sort_values(["YearMonth", "Aircraft_Type", HISTORY_TABLES[table]]))
+    arrow_table = pa.Table.from_pandas(frame, preserve_index=False)
+    months, starts = np.unique(frame["YearMonth"].to_numpy(dtype=str), return_index=True)
+    bounds = list(starts) + [len(frame)]
+
+    # 列構成が変わったら全パーティションを書き直す
+    schema_key = str(arrow_table.schema.remove(arrow_table.schema.get_field_index("YearMonth")))
+    if manifest.get("_schema") != schema_key:
+        manifest = {"_schema": schema_key}
+    # 読み出し時に元の dtype へ戻すため記録しておく
+    manifest["_dtypes"] = {col: str(dtype) for col, dtype in _frame.dtypes.items()}
+    manifest["_source"] = source_key
+
+    for month, start, stop in zip(months, bounds[:-1], bounds[1:]):
+        part = arrow_table.slice(start, stop - start).drop_columns(["YearMonth"])
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_file(sink, part.schema) as writer:
+            writer.write_table(part)
+        buffer = sink.getvalue()
+        digest = hashlib.sha1(buffer).hexdigest()
+        if manifest.get(month) == digest:
+            continue
+
+        part_dir = os.path.join(path, f"YearMonth={month}")
+        os.makedirs(part_dir, exist_ok=True)
+        part_path = os.path.join(part_dir, "part-0.arrow")
+        with open(part_path + ".tmp", "wb") as f:
+            f.write(buffer)
+        os.replace(part_path + ".tmp", part_path)
+        manifest[month] = digest
+
+    # 元データから消えた月は削除
+    for month in [m for m in manifest if not m.startswith("_") and m not in set(months)]:
+        shutil.rmtree(os.path.join(path, f"YearMonth={month}"), ignore_errors=True)
+        del manifest[month]
+
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return path
+
+def open_history_dataset(path):
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs as pafs
+
+    return ds.dataset(
+        path,
+        format="ipc",
+        partitioning=ds.partitioning(pa.schema([("YearMonth", pa.string())]), flavor="hive"),
+        filesystem=pafs.LocalFileSystem(use_mmap=True)
+    )
+
+# 必要な月のパーティションだけをメモリマップで読む（データ版ごとにキャッシュし、再実行時は読み直さない）。
+# dtype は元のフレームに戻す。ただし数値と文字列が混在していた object 列は、保存時に文字列化した値のまま返す
+@st.cache_data
+def read_history_window(path, start_month, data_version, end_month=None, columns=None):
+    import pyarrow.dataset as ds
+
+    expr = ds.field("YearMonth") >= start_month
+    if end_month is not None:
+        expr = expr & (ds.field("YearMonth") <= end_month)
+    frame = open_history_dataset(path).to_table(filter=expr, columns=columns).to_pandas()
+
+    with open(os.path.join(path, "_manifest.json"), encoding="utf-8") as f:
+        dtypes = json.load(f)["_dtypes"]
+    return frame.astype({col: dtype for col, dtype in dtypes.items() if col in frame.columns})
+
+@st.cache_resource
+def get_history_datasets(paths, data_version):
+    return {table: open_history_dataset(path) for table, path in paths.items()}
+
+# DuckDB のパーサで文に分け、SELECT（WITH を含む）1文だけを許可する
+# （"SELECT 1; COPY ... TO ..." のような複文は不可）
+def check_sql_query(query):
+    import duckdb
+
+    statements = duckdb.extract_statements(query)
+    if len(statements) != 1 or statements[0].type != duckdb.StatementType.SELECT:
+        raise ValueError("SELECT / WITH 文を1つだけ実行できます。")
+
+def run_sql(query, paths, data_version):
+    import duckdb
+
+    check_sql_query(query)
+
+    # 実行ごとにインメモリ接続を作り（スレッド間で共有しない）、
+    # pyarrow データセットを登録して列・YearMonth 条件をスキャンに渡す
+    con = duckdb.connect(database=":memory:")
+    try:
+        for table, dataset in get_history_datasets(paths, data_version).items():
+            con.register(table, dataset)
+        # 登録後はファイル読み書き（read_csv / COPY など）を禁止し、設定の変更も封じる
+        con.execute("SET enable_external_access=false")
+        con.execute("SET lock_configuration=true")
+        return con.execute(query).df()
+    finally:
+        con.close()
+
+# -------------------------------
+# 不具合 → イレギュラー の時間窓結合
+# -------------------------------
+IRREGULAR_EVENT_FLAGS = {
+    "Delay_Flag": "DLY", "Cancel_Flag": "CNL", "ShipChange_Flag": "SHIP CHG",
+    "RTO_Flag": "RTO", "ATB_Flag": "ATB", "Diversion_Flag": "DIV", "EngShutDown_Flag": "IFSD"
+}
+
+def label_irregular_events(df_ir):
+    labels = pd.Series("", index=df_ir.index)
+    for flag, name in IRREGULAR_EVENT_FLAGS.items():
+        labels += np.where(df_ir[flag].astype(str).str.strip().str.upper() == "Y", name + "/", "")
+    return labels.str.rstrip("/")
+
+# 各イレギュラーに、同一機番・同一ATAで直前 window 日以内の不具合を as-of 結合
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def link_irregular_to_defects(_df_def, _df_ir, data_version, window_days):
+    window = pd.Timedelta(days=window_days)
+
+    events = _df_ir.dropna(subset=["Tail", "ATA_Chapter"]).copy()
+    events["Event_ID"] = events.index
+    events["Event_Type"] = label_irregular_events(events)
+    # イベント当日の不具合も「直前」として含める（日付単位）
+    events["Event_End"] = events["Date"] + pd.Timedelta(days=1)
+    events = events.sort_values("Event_End")
+
+    defects = _df_def[["Tail", "ATA_Chapter", "Reported_Date", "MOD_Description"]].dropna(subset=["Tail", "Reported_Date"])
+    defects = defects.assign(Defect_ID=defects.index).rename(columns={"Reported_Date": "Defect_Date"})
+    defects = defects.sort_values("Defect_Date")
+
+    linked = pd.merge_asof(
+        events, defects,
+        left_on="Event_End", right_on="Defect_Date",
+        by=["Tail", "ATA_Chapter"],
+        direction="backward",
+        tolerance=window,
+        allow_exact_matches=False
+    )
+
+    # 窓内の不具合件数（同一機番・ATA の日付配列に searchsorted）
+    group_index = pd.Index((defects["Tail"] + "|" + defects["ATA_Chapter"]).unique())
+    defect_codes = group_index.get_indexer(defects["Tail"] + "|" + defects["ATA_Chapter"])
+    order = np.lexsort((defects["Defect_Date"].to_numpy(), defect_codes))
+    day = pd.Timedelta(days=1)
+    all_dates = pd.concat([defects["Defect_Date"], events["Event_End"]])
+    origin = all_dates.min() - window
+    span = (all_dates.max() - origin) / day + window_days + 1
+    defect_keys = defect_codes[order] * span + ((defects["Defect_Date"] - origin) / day).to_numpy()[order]
+
+    event_codes = group_index.get_indexer(linked["Tail"] + "|" + linked["ATA_Chapter"])
+    event_keys = event_codes * span + ((linked["Event_End"] - origin) / day).to_numpy()
+    in_window = (
+        np.searchsorted(defect_keys, event_keys, side="left")
+        - np.searchsorted(defect_keys, event_keys - window_days, side="left")
+    )
+    linked["Defects_In_Window"] = np.where(event_codes >= 0, in_window, 0)
+    linked["Lead_Days"] = (linked["Date"] - linked["Defect_Date"].dt.normalize()) / day
+
+    # 機種 × ATA 別：運航影響につながった不具合
+    summary = (
+        linked.groupby(["Aircraft_Type", "ATA_Chapter"])
+        .agg(
+            Events=("Event_ID", "size"),
+            Linked_Events=("Defect_ID", "count"),
+            Linked_Defects=("Defect_ID", "nunique"),
+            Median_Lead_Days=("Lead_Days", "median"),
+        )
+        .reset_index()
+    )
+    summary["Link_Rate"] = summary["Linked_Events"] / summary["Events"] * 100
+    summary = summary.sort_values(["Linked_Events", "Events"], ascending=False).reset_index(drop=True)
+
+    return linked.sort_values("Date", ascending=False).reset_index(drop=True), summary
+
+# -------------------------------
+# 遅延時間・整備ダウンタイムの分位点スケッチ
+# （相対誤差 SKETCH_ALPHA の対数バケット件数。セル同士は件数の加算でマージできる）
+# -------------------------------
+SKETCH_METRICS = {"遅延時間（分）": "Delay_Time", "整備ダウンタイム（分）": "Total_Maintenance_DownTime"}
+SKETCH_DIMENSIONS = {"ATA": "ATA_Chapter", "機番": "Tail", "Branch": "Branch", "年月": "YearMonth"}
+SKETCH_CELL_KEYS = ["YearMonth", "Aircraft_Type", "ATA_Chapter", "Tail", "Branch"]
+SKETCH_QUANTILES = {"p50": 0.5, "p90": 0.9, "p99": 0.99}
+SKETCH_ALPHA = 0.01
+SKETCH_GAMMA = (1 + SKETCH_ALPHA) / (1 - SKETCH_ALPHA)
+SKETCH_ZERO_BUCKET = np.iinfo(np.int32).min
+
+# 分数（数値 または "H:MM" 表記）
+def parse_minutes(values):
+    minutes = pd.to_numeric(values, errors="coerce")
+    hhmm = values.astype(str).str.extract(r"^\s*(\d+):(\d{2})\s*$").astype(float)
+    return minutes.fillna(hhmm[0] * 60 + hhmm[1])
+
+def sketch_buckets(minutes):
+    with np.errstate(divide="ignore"):
+        buckets = np.ceil(np.log(minutes) / np.log(SKETCH_GAMMA))
+    return np.where(minutes > 0, buckets, SKETCH_ZERO_BUCKET).astype(np.int32)
+
+def sketch_bucket_values(buckets):
+    return np.where(buckets == SKETCH_ZERO_BUCKET, 0.0, 2 * SKETCH_GAMMA ** buckets.astype(float) / (SKETCH_GAMMA + 1))
+
+# キューブのセル（年月 × 機種 × ATA × 機番 × Branch）ごとのスケッチ
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_delay_sketches(_df_ir, data_version):
+    cells = _df_ir[SKETCH_CELL_KEYS].astype("string").fillna("不明")
+    sketches = []
+    for metric in SKETCH_METRICS.values():
+        minutes = parse_minutes(_df_ir[metric])
+        valid = minutes.notna() & (minutes >= 0)
+        sketches.append(
+            cells[valid]
+            .assign(Metric=metric, Bucket=sketch_buckets(minutes[valid].to_numpy()))
+            .groupby(SKETCH_CELL_KEYS + ["Metric", "Bucket"])
+            .size()
+            .rename("Count")
+            .reset_index()
+        )
+    return pd.concat(sketches, ignore_index=True)
+
+# 任意の軸・期間でスケッチをマージし、分位点を求める
+def sketch_quantiles(sketches, metric, by, start_month, end_month):
+    cells = sketches[
+        (sketches["Metric"] == metric) &
+        (sketches["YearMonth"] >= start_month) & (sketches["YearMonth"] <= end_month)
+    ]
+    merged = cells.groupby([by, "Bucket"])["Count"].sum().reset_index()
+    merged["Cum"] = merged.groupby(by)["Count"].cumsum()
+    merged["Total"] = merged.groupby(by)["Count"].transform("sum")
+
+    result = merged.groupby(by)["Total"].first().rename("Events").to_frame()
+    for name, q in SKETCH_QUANTILES.items():
+        hit = merged[merged["Cum"] > q * (merged["Total"] - 1)].groupby(by)["Bucket"].first()
+        result[name] = pd.Series(sketch_bucket_values(hit.to_numpy()), index=hit.index)
+    return result.reset_index()
+
+# -------------------------------
+# 繰り返し不具合（同一機番・同一サブチャプター）
+# -------------------------------
+REPEAT_BASIS = {"日数": "Days", "FC": "FC"}
+REPEAT_COLUMNS = ["Tail", "ATA_SubChapter", "Aircraft_Type", "Reported_Date", "MOD_Description", "Corrective_Action"]
+REPEAT_STATE_MAX_KEYS = 8  # 保持する (基準, 窓) の組み合わせ数（古いものから捨てる）
+
+def compute_repeat_rows(df_def, df_fc, basis, window):
+    rows = df_def[REPEAT_COLUMNS]
+    rows = rows.dropna(subset=["Tail", "ATA_SubChapter"]).sort_values(["Tail", "ATA_SubChapter", "Reported_Date"])
+    rows = rows.reset_index(drop=True)
+
+    if basis == "FC":
+        rows["Position"] = estimate_cumulative_fc(df_fc, rows["Tail"], rows["Reported_Date"])
+        rows = rows.dropna(subset=["Position"]).reset_index(drop=True)
+    else:
+        rows["Position"] = (rows["Reported_Date"] - pd.Timestamp("1970-01-01")).dt.total_seconds() / 86400
+
+    group_codes = rows.groupby(["Tail", "ATA_SubChapter"], sort=False).ngroup().to_numpy()
+    rows["Gap"] = rows.groupby(group_codes)["Position"].diff()
+    rows["Repeat_Count"] = count_in_window(group_codes, rows["Position"], window)
+    rows["Is_Repeat"] = rows["Repeat_Count"] > 0
+    return rows
+
+def summarize_repeat_items(rows):
+    items = (
+        rows.groupby(["Tail", "ATA_SubChapter", "Aircraft_Type"])
+        .agg(
+            Repeats=("Is_Repeat", "sum"),
+            Defects=("Is_Repeat", "size"),
+            Max_In_Window=("Repeat_Count", "max"),
+            Min_Gap=("Gap", "min"),
+            Last_Date=("Reported_Date", "max"),
+        )
+        .reset_index()
+    )
+    items["Max_In_Window"] = items["Max_In_Window"] + 1
+    items = items[items["Repeats"] > 0]
+    return items.sort_values(["Repeats", "Max_In_Window", "Last_Date"], ascending=False).reset_index(drop=True)
+
+# 行の並びによらない内容のダイジェスト（既存行の修正・削除の検出用）
+def repeat_rows_digest(df_def):
+    row_hashes = np.sort(pd.util.hash_pandas_object(df_def[REPEAT_COLUMNS], index=False).to_numpy())
+    return hashlib.sha1(row_hashes.tobytes()).hexdigest()
+
+# 前回結果をプロセス内で保持し、新規レコードがあったグループだけ再計算する
+@st.cache_resource
+def get_repeat_defect_state():
+    return load_state_snapshot("repeat_defects")
+
+@st.cache_resource
+def get_repeat_defect_lock():
+    return threading.Lock()
+
+def detect_repeat_defects(df_def, df_fc, data_version, basis, window):
+    with get_repeat_defect_lock():
+        return update_repeat_defects(df_def, df_fc, data_version, basis, window)
+
+def update_repeat_defects(df_def, df_fc, data_version, basis, window):
+    state = get_repeat_defect_state()
+    prev = state.get((basis, window))
+    if prev is not None and prev["data_version"] == data_version:
+        state[(basis, window)] = state.pop((basis, window))
+        return prev["rows"], prev["items"]
+
+    # 前回の最終日以前の行が1行も変わっていない（追加のみ）ときだけ差分更新
+    fc_version = get_file_version(FC_FILE)
+    new_mask = df_def["Reported_Date"] > prev["max_date"] if prev is not None else None
+    incremental = (
+        prev is not None
+        and prev["fc_version"] == fc_version
+        and repeat_rows_digest(df_def[~new_mask]) == prev["digest"]
+    )
+
+    if incremental:
+        new_groups = df_def.loc[new_mask, ["Tail", "ATA_SubChapter"]].drop_duplicates()
+        group_key = pd.MultiIndex.from_frame(new_groups)
+        affected_def = pd.MultiIndex.from_frame(df_def[["Tail", "ATA_SubChapter"]]).isin(group_key)
+        affected_prev = pd.MultiIndex.from_frame(prev["rows"][["Tail", "ATA_SubChapter"]]).isin(group_key)
+        rows = pd.concat([
+            prev["rows"][~affected_prev],
+            compute_repeat_rows(df_def[affected_def], df_fc, basis, window),
+        ]).sort_values(["Tail", "ATA_SubChapter", "Reported_Date"]).reset_index(drop=True)
+    else:
+        rows = compute_repeat_rows(df_def, df_fc, basis, window)
+
+    items = summarize_repeat_items(rows)
+    # 組み合わせごとに最新のデータ版だけを残し、最近使ったものから REPEAT_STATE_MAX_KEYS 件まで保持
+    state.pop((basis, window), None)
+    state[(basis, window)] = {
+        "data_version": data_version,
+        "fc_version": fc_version,
+        "max_date": df_def["Reported_Date"].max(),
+        "digest": repeat_rows_digest(df_def),
+        "rows": rows,
+        "items": items,
+    }
+    for key in list(state)[:-REPEAT_STATE_MAX_KEYS]:
+        del state[key]
+    save_state_snapshot("repeat_defects", state)
+    return rows, items
+
+# -------------------------------
+# 機番 × ATA 累積件数行列（月方向に累積 → 任意期間は2枚の差分で求まる）
+# -------------------------------
+HEATMAP_MAX_ATA = 40
+HEATMAP_OUTLIER_SIGMA = 2.5
+HEATMAP_OUTLIER_MIN_COUNT = 3
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_tail_ata_cumulative(_df, _df_fc, data_version, ata_col):
+    frame = _df.dropna(subset=["Tail", ata_col])
+    months = pd.period_range(frame["YearMonth"].min(), frame["YearMonth"].max(), freq="M").strftime("%Y-%m")
+    tail_codes, tails = pd.factorize(frame["Tail"], sort=True)
+    ata_codes, atas = pd.factorize(frame[ata_col].astype(str), sort=True)
+
+    # (月+1, 機番, ATA) の件数を先頭0行付きで累積
+    counts = np.zeros((len(months) + 1, len(tails), len(atas)), dtype=np.int32)
+    np.add.at(counts, (months.get_indexer(frame["YearMonth"]) + 1, tail_codes, ata_codes), 1)
+
+    fc = _df_fc[_df_fc["Tail"].isin(tails) & _df_fc["YearMonth"].isin(months)]
+    fc_by_month = np.zeros((len(months) + 1, len(tails)))
+    np.add.at(fc_by_month, (months.get_indexer(fc["YearMonth"]) + 1, tails.get_indexer(fc["Tail"])), fc["FC"].to_numpy(dtype=float))
+
+    return {
+        "months": months,
+        "tails": tails,
+        "tail_types": classify_aircraft_type(pd.Series(tails)).to_numpy(),
+        "atas": atas,
+        "cum_counts": counts.cumsum(axis=0),
+        "cum_fc": fc_by_month.cumsum(axis=0),
+    }
+
+# 期間 [start_month, end_month] の件数行列（機番 × ATA）と機番別 FC
+def tail_ata_window(matrix, start_month, end_month):
+    i = matrix["months"].get_loc(start_month)
+    j = matrix["months"].get_loc(end_month) + 1
+    return matrix["cum_counts"][j] - matrix["cum_counts"][i], matrix["cum_fc"][j] - matrix["cum_fc"][i]
+
+# -------------------------------
+# P/N 取り外し間隔（同一機番・同一 P/N の連続交換の間隔、日数と FC）
+# -------------------------------
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_pn_removal_index(_df_def, _df_fc, data_version):
+    rows = _df_def[["PN", "Tail", "Aircraft_Type", "ATA_Chapter", "Reported_Date", "MOD_Description"]]
+    rows = rows.dropna(subset=["PN", "Tail", "Reported_Date"])
+    rows = rows.assign(PN=rows["PN"].astype(str).str.strip())
+    rows = rows.sort_values(["PN", "Tail", "Reported_Date"], kind="stable").reset_index(drop=True)
+
+    # 交換時点の累積FC（月次FCの日割り）と、同一 P/N・機番内の前回交換からの差分
+    rows["Cum_FC"] = estimate_cumulative_fc(_df_fc, rows["Tail"], rows["Reported_Date"])
+    grouped = rows.groupby(["PN", "Tail"], sort=False)
+    rows["Interval_Days"] = grouped["Reported_Date"].diff().dt.days
+    rows["Interval_FC"] = grouped["Cum_FC"].diff()
+
+    # P/N → 行区間（PN 順に並んでいるので連続）
+    slices = {
+        pn: slice(int(positions[0]), int(positions[-1]) + 1)
+        for pn, positions in rows.groupby("PN", sort=False).indices.items()
+    }
+
+    # フリート全体のランキング（平均取り外し間隔が短い順）
+    ranking = (
+        rows.groupby("PN")
+        .agg(
+            Removals=("Reported_Date", "size"),
+            Tails=("Tail", "nunique"),
+            Intervals=("Interval_Days", "count"),
+            MTBUR_Days=("Interval_Days", "mean"),
+            Median_Days=("Interval_Days", "median"),
+            Min_Days=("Interval_Days", "min"),
+            MTBUR_FC=("Interval_FC", "mean"),
+            Last_Date=("Reported_Date", "max"),
+        )
+        .reset_index()
+    )
+    ranking = ranking[ranking["Intervals"] > 0].sort_values(
+        ["MTBUR_Days", "Removals"], ascending=[True, False]
+    ).reset_index(drop=True)
+
+    return {"rows": rows, "slices": slices, "ranking": ranking}
+
+def lookup_pn_removals(index, pn):
+    return index["rows"].iloc[index["slices"].get(pn, slice(0, 0))]
+
+# -------------------------------
+# Top Driver ランキング（直近12か月の Top-K を全月分事前計算）
+# -------------------------------
+TOP_DRIVER_KEYS = {
+    "不具合内容": "MOD_Description",
+    "不具合内容（表記ゆれ統合）": "MOD_Cluster",
+    "サブチャプター": "ATA_SubChapter",
+    "P/N": "PN"
+}
+TOP_DRIVER_K = 10
+TOP_DRIVER_WINDOW = 12
+
+# Seat/IFE/WiFi（Top Driver 用の除外条件）
+def top_driver_exclude_mask(df):
+    exclude_patterns = ["2520", "2521", "2528"] + [f"442{i}" for i in range(10)] + [f"443{i}" for i in range(10)]
+    seat = (df['ATA_Chapter'] == "0") & df['MOD_Description'].astype(str).str.lower().str.contains("seat", na=False)
+    return df['ATA_SubChapter'].isin(exclude_patterns) | seat
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_top_driver_rankings(_df, data_version, key_col):
+    frame = _df[["YearMonth", "Aircraft_Type", key_col]].assign(Excluded=top_driver_exclude_mask(_df))
+    frame = frame.dropna(subset=[key_col])
+
+    # キーをカテゴリコード化、月は連続した暦月の番号
+    codes, labels = pd.factorize(frame[key_col].astype(str), sort=True)
+    months = pd.period_range(frame["YearMonth"].min(), frame["YearMonth"].max(), freq="M").strftime("%Y-%m")
+    frame = frame.assign(Code=codes, Month_Index=months.get_indexer(frame["YearMonth"]))
+
+    ranking_frames, trend_frames = [], []
+    for filtered in (False, True):
+        target = frame[~frame["Excluded"]] if filtered else frame
+        monthly = target.groupby(["Aircraft_Type", "Month_Index", "Code"]).size().rename("Count").reset_index()
+
+        for aircraft_type, type_monthly in monthly.groupby("Aircraft_Type"):
+            by_month = {m: g for m, g in type_monthly.groupby("Month_Index")}
+            running = np.zeros(len(labels), dtype=np.int64)
+            ranks = []
+
+            # 月送りで窓に入る月を加算、外れる月を減算し、Top-K を取り直す
+            for m in range(len(months)):
+                if m in by_month:
+                    np.add.at(running, by_month[m]["Code"].to_numpy(), by_month[m]["Count"].to_numpy())
+                if m - TOP_DRIVER_WINDOW in by_month:
+                    out = by_month[m - TOP_DRIVER_WINDOW]
+                    np.subtract.at(running, out["Code"].to_numpy(), out["Count"].to_numpy())
+
+                k = min(TOP_DRIVER_K, int((running > 0).sum()))
+                if k == 0:
+                    continue
+                top = np.argpartition(-running, k - 1)[:k]
+                top = top[np.lexsort((top, -running[top]))]
+                ranks.append(pd.DataFrame({
+                    "End_Index": m, "Rank": np.arange(1, k + 1), "Code": top, "Window_Count": running[top]
+                }))
+
+            if not ranks:
+                continue
+            ranks = pd.concat(ranks, ignore_index=True).assign(Aircraft_Type=aircraft_type, Filtered=filtered)
+            ranking_frames.append(ranks)
+
+            # 各ランキングの推移（窓内の月別件数）
+            trend = ranks[["End_Index", "Code", "Aircraft_Type", "Filtered"]].merge(
+                type_monthly[["Month_Index", "Code", "Count"]], on="Code"
+            )
+            trend = trend[
+                (trend["Month_Index"] <= trend["End_Index"]) &
+                (trend["Month_Index"] > trend["End_Index"] - TOP_DRIVER_WINDOW)
+            ]
+            trend_frames.append(trend)
+
+    rankings = pd.concat(ranking_frames, ignore_index=True)
+    trends = pd.concat(trend_frames, ignore_index=True)
+    for table in (rankings, trends):
+        table["YearMonth"] = months[table["End_Index"].to_numpy()]
+        table[key_col] = labels[table["Code"].to_numpy()]
+    trends["Month"] = months[trends["Month_Index"].to_numpy()]
+
+    rankings = rankings.set_index(["Aircraft_Type", "Filtered", "YearMonth"]).sort_index()
+    trends = (
+        trends.sort_values(["Month", key_col])
+        .set_index(["Aircraft_Type", "Filtered", "YearMonth"])
+        .sort_index(kind="stable")
+    )
+    return rankings, trends
+
+def lookup_top_driver(table, aircraft_type, filtered, year_month):
+    key = (aircraft_type, filtered, year_month)
+    if key not in table.index:
+        return table.iloc[0:0].reset_index()
+    return table.loc[[key]].reset_index()
+
+# -------------------------------
+# ATA → サブチャプター → 機番 ドリルダウン索引（データ版ごとに1回構築）
+# 読み取り専用の索引なので cache_resource で共有する（cache_data だと参照のたびに unpickle される）
+# -------------------------------
+DRILLDOWN_LEVELS = ["Aircraft_Type", "ATA_Chapter", "ATA_SubChapter", "Tail"]
+
+@st.cache_resource(max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_drilldown_index(_df, data_version):
+    # 階層キー順に並べ替え（同一キー内は元の並び）→ 各キーの行は連続した区間になる
+    frame = _df.sort_values(DRILLDOWN_LEVELS, kind="stable").reset_index(drop=True)
+
+    # (機種,) (機種, ATA) (機種, ATA, サブ) (機種, ATA, サブ, 機番) → 行区間
+    slices = {}
+    for depth in range(1, len(DRILLDOWN_LEVELS) + 1):
+        groups = frame.groupby(DRILLDOWN_LEVELS[:depth], sort=False, dropna=False).indices
+        for key, positions in groups.items():
+            key = key if isinstance(key, tuple) else (key,)
+            slices[key] = slice(int(positions[0]), int(positions[-1]) + 1)
+
+    # ATA 候補（件数降順）と ATA 内のサブチャプター一覧（全機種共通・昇順）
+    ata_counts = frame.groupby("ATA_Chapter").size().sort_values(ascending=False, kind="stable")
+    ata_options = ata_counts.index.tolist()
+    ata_subchapters = {
+        ata: sorted(subs) for ata, subs in frame.groupby("ATA_Chapter")["ATA_SubChapter"].unique().items()
+    }
+
+    # (機種, ATA) → サブチャプター候補（件数降順）、(機種, ATA, サブ) → 機番候補（昇順）
+    sub_counts = frame.groupby(DRILLDOWN_LEVELS[:3]).size()
+    sub_options = {
+        key: group.sort_values(ascending=False, kind="stable").index.get_level_values("ATA_SubChapter").tolist()
+        for key, group in sub_counts.groupby(level=[0, 1])
+    }
+    tail_options = {}
+    for key in slices:
+        if len(key) == len(DRILLDOWN_LEVELS) and pd.notna(key[-1]):
+            tail_options.setdefault(key[:-1], []).append(key[-1])
+
+    return {
+        "frame": frame,
+        "slices": slices,
+        "ata_options": ata_options,
+        "ata_subchapters": ata_subchapters,
+        "sub_options": sub_options,
+        "tail_options": tail_options,
+    }
+
+def drilldown_rows(index, *key):
+    frame = index["frame"]
+    return frame.iloc[index["slices"].get(key, slice(0, 0))]
+
+# -------------------------------
+# 時系列グラフの描画（WebGL 切替・サーバー側間引き）
+# -------------------------------
+RENDER_MODES = {"自動": "auto", "SVG": "svg", "WebGL": "webgl"}
+WEBGL_POINT_THRESHOLD = 1000
+
+def use_webgl(n_points, render_mode):
+    return render_mode == "webgl" or (render_mode == "auto" and n_points > WEBGL_POINT_THRESHOLD)
+
+# Largest-Triangle-Three-Buckets：形状を保ったまま n_out 点に間引く（残す行番号を返す）
+def lttb_indices(x, y, n_out):
+    n = len(x)
+    if n_out >= n or n_out < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, n_out - 1).astype(int)
+    keep = np.empty(n_out, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    a = 0
+    for i in range(n_out - 2):
+        start, stop = edges[i], edges[i + 1]
+        next_stop = edges[i + 2] if i + 2 < len(edges) else n
+        avg_x, avg_y = x[stop:next_stop].mean(), y[stop:next_stop].mean()
+        area = np.abs((x[a] - avg_x) * (y[start:stop] - y[a]) - (x[a] - x[start:stop]) * (avg_y - y[a]))
+        a = start + int(np.argmax(area))
+        keep[i + 1] = a
+    return keep
+
+def make_line_trace(x, y, render_mode="auto", max_points=None, text=None, **kwargs):
+    x = np.asarray(x)
+    y = np.asarray(y, dtype=float)
+    if max_points and len(x) > max_points:
+        if np.issubdtype(x.dtype, np.datetime64):
+            x_num = x.astype("datetime64[ns]").astype(np.int64).astype(float)
+        else:
+            x_num = np.arange(len(x), dtype=float)
+        keep = lttb_indices(x_num, np.nan_to_num(y), max_points)
+        # 間引いた場合は点ごとのラベルを付けない
+        x, y, text = x[keep], y[keep], None
+
+    trace = go.Scattergl if use_webgl(len(x), render_mode) else go.Scatter
+    return trace(x=x, y=y, text=text, **kwargs)
+
+# -------------------------------
+# 図のキャッシュ（データ版・セクション・パラメータ単位）
+# -------------------------------
+FIGURE_CACHE_SIZE = 256
+
+# 全セッション共有のため、図オブジェクトではなく dict で保持し、取り出すたびに新しい go.Figure を作る
+@st.cache_resource
+def get_figure_cache():
+    return OrderedDict()
+
+@st.cache_resource
+def get_figure_cache_lock():
+    return threading.Lock()
+
+# 数値配列を numpy 配列にそろえる（plotly が JSON リストではなく型付き配列で出力する）
+def compact_figure(fig):
+    for trace in fig.data:
+        for attr in ("x", "y", "z", "values"):
+            values = getattr(trace, attr, None)
+            if isinstance(values, (list, tuple)) and values and all(
+                isinstance(v, (int, float, np.number)) and not isinstance(v, bool) for v in values
+            ):
+                setattr(trace, attr, np.asarray(values, dtype=float))
+    return fig
+
+def cached_figure(section, params, build):
+    cache = get_figure_cache()
+    key = (DATA_VERSION, section) + tuple(params)
+    with get_figure_cache_lock():
+        specs = cache.get(key)
+        if specs is not None:
+            cache.move_to_end(key)
+
+    if specs is None:
+        built = build()
+        figures = built if isinstance(built, tuple) else (built,)
+        specs = tuple(compact_figure(f).to_dict() for f in figures)
+        with get_figure_cache_lock():
+            cache[key] = specs
+            while len(cache) > FIGURE_CACHE_SIZE:
+                cache.popitem(last=False)
+
+    figures = tuple(go.Figure(spec) for spec in specs)
+    return figures if len(figures) > 1 else figures[0]
+
+# -------------------------------
+# 表のエクスポート（ダウンロードボタンを押した時点でセッション内で生成し、サーバーにはファイルを残さない）
+# -------------------------------
+EXPORT_FORMATS = {"CSV": "csv", "Excel": "xlsx", "Parquet": "parquet"}
+EXPORT_MIME_TYPES = {
+    "csv": "text/csv",
+    "xlsx": "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+    "parquet": "application/vnd.apache.parquet",
+}
+EXPORT_CSV_CHUNKSIZE = 50_000
+
+# 書き出し先のバッファを先頭に戻して返す（download_button はファイルライクをそのまま受け取る）
+def export_file(frame, fmt):
+    buffer = io.BytesIO()
+    if fmt == "csv":
+        frame.to_csv(buffer, index=False, chunksize=EXPORT_CSV_CHUNKSIZE, encoding="utf-8-sig")
+    elif fmt == "xlsx":
+        from openpyxl import Workbook
+        wb = Workbook(write_only=True)
+        ws = wb.create_sheet("data")
+        ws.append([str(c) for c in frame.columns])
+        for row in frame.astype(object).where(frame.notna(), None).itertuples(index=False, name=None):
+            ws.append(row)
+        wb.save(buffer)
+    else:
+        to_columnar_frame(frame).to_parquet(buffer, index=False)
+    buffer.seek(0)
+    return buffer
+
+# 表示中の行をそのまま書き出す（生成はクリック時に別スレッドで行われ、再実行を止めない）
+def export_panel(frame, name, key):
+    with st.expander("⬇ エクスポート（CSV / Excel / Parquet）"):
+        fmt = EXPORT_FORMATS[st.radio("形式", list(EXPORT_FORMATS), horizontal=True, key=f"{key}_format")]
+        # 浅いコピー（後続処理での列追加の影響を受けない）
+        snapshot = frame.copy(deep=False)
+        st.download_button(
+            f"📥 {name}.{fmt}（{len(frame):,} 行）",
+            data=lambda: export_file(snapshot, fmt),
+            file_name=f"{name}.{fmt}",
+            mime=EXPORT_MIME_TYPES[fmt],
+            key=f"{key}_download",
+            on_click="ignore"
+        )
+
+# -------------------------------
+# 保存ビュー（機種・ATA・サブチャプター・機番・期間・除外条件の組み合わせに名前を付けて保存し、
+# 結果をデータ版ごとにバックグラウンドで事前計算しておく）
+# -------------------------------
+SAVED_VIEWS_FILE = "saved_views.json"
+VIEW_RESULT_DIR = os.path.join(".cache", "views")
+VIEW_PARAM = "view"
+VIEW_ALL = "すべて"
+VIEW_NONE = "（選択なし）"
+VIEW_DEFECT_COLUMNS = ["ATA_SubChapter", "Reported_Date_Only", "Tail", "MOD_Description", "Corrective_Action"]
+VIEW_IRREGULAR_COLUMNS = ["Date", "Tail", "FLT_Number", "ATA_SubChapter", "Description", "Work_Performed"]
+
+@st.cache_resource
+def get_view_lock():
+    return threading.Lock()
+
+@st.cache_resource
+def get_view_executor():
+    return ThreadPoolExecutor(max_workers=1, thread_name_prefix="views")
+
+# (ビュー digest, データ版) → 事前計算ジョブ
+@st.cache_resource
+def get_view_jobs():
+    return {}
+
+# ビュー digest → {"data_version", "result"}（再起動後はディスクから読み直す）
+@st.cache_resource
+def get_view_results():
+    return {}
+
+def load_saved_views():
+    try:
+        with open(SAVED_VIEWS_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+def save_saved_views(views):
+    with get_view_lock():
+        with open(SAVED_VIEWS_FILE + ".tmp", "w", encoding="utf-8") as f:
+            json.dump(views, f, ensure_ascii=False, indent=2)
+        os.replace(SAVED_VIEWS_FILE + ".tmp", SAVED_VIEWS_FILE)
+
+# 条件が同じなら名前が違っても同じ結果を共有する
+def view_digest(view):
+    return hashlib.sha1(json.dumps(view, sort_keys=True).encode()).hexdigest()[:16]
+
+def load_view_result(digest):
+    results = get_view_results()
+    if digest not in results:
+        try:
+            with open(os.path.join(VIEW_RESULT_DIR, f"{digest}.pkl"), "rb") as f:
+                results[digest] = pickle.load(f)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+    return results[digest]
+
+# cabin_filter / normalize_ata はバックグラウンドスレッドから呼ぶため引数で明示的に受け取る
+def materialize_view(view, df_def, df_ir, cabin_filter, normalize_ata):
+    if view["exclude_cabin"]:
+        df_def, df_ir = cabin_filter(df_def, df_ir)
+    # イレギュラーの ATA は不具合と同じ4桁表記にそろえてから絞り込む
+    df_ir = normalize_ata(df_ir)
+    start = pd.Timestamp(view["start"])
+    end = pd.Timestamp(view["end"]) + pd.Timedelta(days=1)
+
+    selected = {}
+    for source, frame, date_col in (("defects", df_def, "Reported_Date"), ("irregular", df_ir, "Date")):
+        mask = (frame[date_col] >= start) & (frame[date_col] < end) & (frame["ATA_Chapter"] == view["ata"])
+        for col, key in (("Aircraft_Type", "aircraft"), ("ATA_SubChapter", "sub"), ("Tail", "tail")):
+            if view[key] != VIEW_ALL:
+                mask &= frame[col] == view[key]
+        selected[source] = frame[mask]
+    defects, irregular = selected["defects"], selected["irregular"]
+
+    # 月別：不具合はサブチャプター別の積み上げ、イレギュラーは件数の折れ線
+    months = pd.period_range(start, view["end"], freq="M").astype(str)
+    defect_monthly = (
+        defects.groupby(["YearMonth", "ATA_SubChapter"]).size()
+        .unstack(fill_value=0)
+        .reindex(months, fill_value=0)
+    )
+    irregular_monthly = irregular.groupby("YearMonth").size().reindex(months, fill_value=0)
+
+    fig = go.Figure()
+    for sub in defect_monthly.columns:
+        fig.add_trace(go.Bar(x=list(months), y=defect_monthly[sub].tolist(), name=sub))
+    fig.add_trace(go.Scatter(
+        x=list(months), y=irregular_monthly.tolist(), name="イレギュラー",
+        mode="lines+markers", yaxis="y2", marker_color="crimson"
+    ))
+    fig.update_layout(
+        title=f"ATA{view['ata']} 月別不具合件数（サブチャプター別）& イレギュラー件数",
+        barmode="stack",
+        xaxis_title="年月",
+        yaxis=dict(title="不具合件数"),
+        yaxis2=dict(title="イレギュラー件数", overlaying="y", side="right"),
+        hovermode="x unified",
+        margin=dict(t=50)
+    )
+
+    return {
+        "summary": {
+            "不具合件数": len(defects),
+            "イレギュラー件数": len(irregular),
+            "機番数": pd.concat([defects["Tail"], irregular["Tail"]]).nunique(),
+        },
+        "figure": compact_figure(fig),
+        "defects": defects[VIEW_DEFECT_COLUMNS].sort_values("Reported_Date_Only", ascending=False),
+        "irregular": irregular[VIEW_IRREGULAR_COLUMNS].sort_values("Date", ascending=False),
+    }
+
+def refresh_view(digest, view, df_def, df_ir, data_version, cabin_filter, normalize_ata):
+    entry = {"data_version": data_version, "result": materialize_view(view, df_def, df_ir, cabin_filter, normalize_ata)}
+    with get_view_lock():
+        # 計算中に削除されたビューは書き出さない
+        if (digest, data_version) not in get_view_jobs():
+            return
+        os.makedirs(VIEW_RESULT_DIR, exist_ok=True)
+        path = os.path.join(VIEW_RESULT_DIR, f"{digest}.pkl")
+        with open(path + ".tmp", "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(path + ".tmp", path)
+        get_view_results()[digest] = entry
+
+# 削除したビューの事前計算ジョブと結果（メモリ・ディスク）を捨てる。同じ条件の別名ビューが残っていれば共有中なので残す
+def discard_view_result(views, digest):
+    if any(view_digest(view) == digest for view in views.values()):
+        return
+    with get_view_lock():
+        jobs = get_view_jobs()
+        for key in [key for key in jobs if key[0] == digest]:
+            jobs.pop(key).cancel()
+        get_view_results().pop(digest, None)
+        try:
+            os.remove(os.path.join(VIEW_RESULT_DIR, f"{digest}.pkl"))
+        except FileNotFoundError:
+            pass
+
+# 現在のデータ版で未計算のビューだけをバックグラウンドで計算する（表示側は集計しない）
+def schedule_view_refresh(views, df_def, df_ir, data_version):
+    jobs = get_view_jobs()
+    for view in views.values():
+        digest = view_digest(view)
+        entry = load_view_result(digest)
+        if (entry is not None and entry["data_version"] == data_version) or (digest, data_version) in jobs:
+            continue
+        # 浅いコピー（後続処理での列追加の影響を受けない）
+        jobs[(digest, data_version)] = get_view_executor().submit(
+            refresh_view, digest, view, df_def.copy(deep=False), df_ir.copy(deep=False), data_version,
+            filter_cabin_related_both, normalize_irregular_ata
+        )
+
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def build_daily_defect_counts(_df, data_version):
+    daily = (
+        _df.groupby([_df['Reported_Date'].dt.normalize(), 'Aircraft_Type'])
+        .size()
+        .unstack(fill_value=0)
+    )
+    days = pd.date_range(daily.index.min(), daily.index.max(), freq="D")
+    return daily.reindex(days, fill_value=0)
+
+# -------------------------------
+# 表示
+# -------------------------------
+st.title("A350 Monitoring Dashboard")
+
+# グラフ描画設定（点数が多い場合は WebGL とサーバー側間引きを使う）
+with st.sidebar:
+    st.markdown("#### グラフ描画")
+    chart_render_mode = RENDER_MODES[st.radio("描画モード", list(RENDER_MODES.keys()), key="chart_render_mode")]
+    chart_max_points = st.slider("最大表示点数（系列あたり）", min_value=200, max_value=5000, value=1000, step=100)
+
+# -------------------------------
+# 📌 保存ビュー（事前計算済みの結果だけを表示。?view=ビュー名 で共有）
+# -------------------------------
+saved_views = load_saved_views()
+requested_view = st.query_params.get(VIEW_PARAM)
+
+with st.expander("📌 Saved Views", expanded=requested_view in saved_views):
+    view_options = [VIEW_NONE] + list(saved_views)
+    selected_view = st.selectbox(
+        "保存ビュー",
+        view_options,
+        index=view_options.index(requested_view) if requested_view in saved_views else 0,
+        key="saved_view"
+    )
+
+    if selected_view in saved_views:
+        st.query_params[VIEW_PARAM] = selected_view
+        view = saved_views[selected_view]
+        digest = view_digest(view)
+        entry = load_view_result(digest)
+        job = get_view_jobs().get((digest, DATA_VERSION))
+
+        st.caption(
+            f"機種: {view['aircraft']} / ATA: {view['ata']} / サブチャプター: {view['sub']} / 機番: {view['tail']} / "
+            f"期間: {view['start']} 〜 {view['end']} / Seat/IFE/WiFi除外: {'あり' if view['exclude_cabin'] else 'なし'}"
+        )
+        st.markdown(f"[🔗 このビューへのリンク](?{VIEW_PARAM}={quote(selected_view)})")
+
+        if job is not None and job.done() and not job.cancelled() and job.exception() is not None:
+            st.error(f"ビューの更新に失敗: {job.exception()}")
+        if entry is None:
+            st.info("集計中です。しばらくしてから再表示してください。")
+            st.button("再表示", key="saved_view_refresh")
+        else:
+            if entry["data_version"] != DATA_VERSION:
+                st.caption("⚠ 前回のデータ版の結果を表示中（バックグラウンドで更新中）")
+            result = entry["result"]
+            for col, (label, value) in zip(st.columns(len(result["summary"])), result["summary"].items()):
+                col.metric(label, f"{value:,}")
+            st.plotly_chart(result["figure"], use_container_width=True)
+            st.dataframe(result["defects"], use_container_width=True, hide_index=True, height=300)
+            st.dataframe(result["irregular"], use_container_width=True, hide_index=True, height=300)
+    elif VIEW_PARAM in st.query_params:
+        del st.query_params[VIEW_PARAM]
+
+# 履歴ストア（直近期間のビューは必要な月のパーティションだけを読む）
+history_paths = {
+    "defects": build_history_store(df, "defects", get_file_version(DEFECT_FILE)),
+    "irregular": build_history_store(df_irregular, "irregular", get_file_version(IRREGULAR_FILE)),
+}
+
+latest_date = df['Reported_Date'].max()
+one_year_ago = latest_date - DateOffset(years=1)
+df_recent_1y = read_history_window(history_paths["defects"], one_year_ago.strftime('%Y-%m'), DATA_VERSION)
+df_recent_1y = df_recent_1y[df_recent_1y['Reported_Date'] >= one_year_ago]
+
+
+# -------------------------------
+# 📊 月別推移グラフ（不具合 + イレギュラー）
+# -------------------------------
+st.subheader("📊 A350 Fleet Brief")
+
+filter_exclude_graph = st.checkbox("Seat/IFE/WiFiを除く（グラフ適用）")
+
+def build_fleet_brief():
+    if filter_exclude_graph:
+        df_recent_1y_filtered, df_irregular_filtered = filter_cabin_related_both(df_recent_1y, df_irregular)
+    else:
+        df_recent_1y_filtered, df_irregular_filtered = df_recent_1y, df_irregular
+
+    # 不具合・イレギュラー（月別）
+    monthly_combined = build_monthly_combined(
+        df_recent_1y_filtered, df_irregular_filtered, DATA_VERSION, filter_exclude_graph
+    )
+
+    # グラフ作成
+    fig_total = go.Figure()
+    # 折れ線（不具合）- 左軸
+    for col in [f"Defect_{ac_type}" for ac_type in FLEET_TYPE_NAMES] + ["Defect_Total"]:
+        fig_total.add_trace(make_line_trace(
+            x=monthly_combined["YearMonth"],
+            y=monthly_combined[col],
+            render_mode=chart_render_mode,
+            max_points=chart_max_points,
+            mode="lines+markers",
+            name=f"不具合 {col.replace('Defect_', '')}",
+            yaxis="y1"
+        ))
+    # 棒（イレギュラー）- 右軸
+    fig_total.add_trace(go.Bar(
         x=monthly_combined["YearMonth"],
-        y=monthly_combined[col],
-        mode="lines+markers",
-        name=f"不具合 {col.replace('Defect_', '')}",
-        yaxis="y1"
+        y=monthly_combined["Irreg_Total"],
+        name="イレギュラー件数",
+        yaxis="y2",
+        opacity=0.5
     ))
-# 棒（イレギュラー）- 右軸
-fig_total.add_trace(go.Bar(
-    x=monthly_combined["YearMonth"],
-    y=monthly_combined["Irreg_Total"],
-    name="イレギュラー件数",
-    yaxis="y2",
-    opacity=0.5
-))
-fig_total.update_layout(
-    title="A350全体・機種別 月別不具合件数 & イレギュラー件数",
-    xaxis=dict(type="category", title="年月"),
-    yaxis=dict(title="不具合件数", side="left"),
-    yaxis2=dict(title="イレギュラー件数", overlaying="y", side="right"),
-    barmode="overlay"
-)
+    fig_total.update_layout(
+        title="A350全体・機種別 月別不具合件数 & イレギュラー件数",
+        xaxis=dict(type="category", title="年月"),
+        yaxis=dict(title="不具合件数", side="left"),
+        yaxis2=dict(title="イレギュラー件数", overlaying="y", side="right"),
+        barmode="overlay"
+    )
+    return fig_total
+
+fig_total = cached_figure("fleet_brief", (filter_exclude_graph, chart_render_mode, chart_max_points), build_fleet_brief)
 st.plotly_chart(fig_total, use_container_width=True)
 
+# -------------------------------
+# 📈 日別不具合件数（長期・表示期間に合わせて間引き）
+# -------------------------------
+with st.expander("📈 日別不具合件数（全期間）"):
+    daily_counts = build_daily_defect_counts(df, DATA_VERSION)
+    daily_start, daily_end = st.slider(
+        "表示期間",
+        min_value=daily_counts.index.min().date(),
+        max_value=daily_counts.index.max().date(),
+        value=(daily_counts.index.min().date(), daily_counts.index.max().date()),
+        format="YYYY-MM-DD",
+        key="daily_range"
+    )
+    daily_view = daily_counts.loc[str(daily_start):str(daily_end)]
+
+    def build_daily_chart():
+        fig_daily = go.Figure()
+        for ac_type in daily_view.columns:
+            fig_daily.add_trace(make_line_trace(
+                x=daily_view.index.values,
+                y=daily_view[ac_type].values,
+                render_mode=chart_render_mode,
+                max_points=chart_max_points,
+                mode="lines",
+                name=ac_type
+            ))
+        fig_daily.update_layout(
+            title=f"日別不具合件数（{daily_start} 〜 {daily_end}、{len(daily_view)} 日）",
+            xaxis=dict(type="date", title="日付"),
+            yaxis=dict(title="不具合件数"),
+            hovermode="x unified"
+        )
+        return fig_daily
+
+    fig_daily = cached_figure(
+        "daily_defects", (daily_start, daily_end, chart_render_mode, chart_max_points), build_daily_chart
+    )
+    st.plotly_chart(fig_daily, use_container_width=True)
+
 # --- FCデータ読み込み関数 ---
-@st.cache_data
-def load_fc_data():
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
+def load_fc_data(file_version):
     import re
 
-    file_path = "FHFC(Airbus).xlsx"
+    file_path = FC_FILE
     xls = pd.ExcelFile(file_path)
     sheet_names = xls.sheet_names
     all_data = []
+    quarantine = []
 
     for sheet in sheet_names:
         try:
@@ -261,31 +1804,27 @@ def load_fc_data():
             df_fcy = df_sheet.loc[mask_fcy, [1, 3]].copy()
             df_fcy.columns = ["Tail", "FC"]
 
-            # A350-900 or A350-1000 判定
-            # → Tail 番号の位置から判断（JA01XJ〜JA39XJくらいがA350-900、それ以降はA350-1000）
-            def get_type(tail):
-                try:
-                    num = int(str(tail)[2:4])
-                    return "A350-900" if num <= 39 else "A350-1000"
-                except:
-                    return "Unknown"
+            # 型変換（Tail 欠損・FC が数値でない行は quarantine へ。行番号は「シート名!行」）
+            df_fcy, issues = apply_schema(df_fcy, FC_SCHEMA, "fc", [f"{sheet}!{i + 1}" for i in df_fcy.index])
+            quarantine.append(issues)
 
-            df_fcy["Aircraft_Type"] = df_fcy["Tail"].apply(get_type)
+            # 機種判定（不具合・イレギュラーと同じレジストリ）
+            df_fcy["Aircraft_Type"] = classify_aircraft_type(df_fcy["Tail"])
             df_fcy["YearMonth"] = yearmonth
 
-            # 数値化
-            df_fcy["FC"] = pd.to_numeric(df_fcy["FC"], errors="coerce")
-            df_fcy = df_fcy.dropna(subset=["FC"])
-
             all_data.append(df_fcy)
 
         except Exception as e:
-            st.warning(f"{sheet} 読み込み失敗: {e}")
+            quarantine.append(pd.DataFrame([{
+                "Source": "fc", "Row": sheet, "Column": "", "Reason": f"シート読み込み失敗: {e}",
+                "Value": "", "Action": "シートを除外"
+            }]))
 
+    quarantine = pd.concat(quarantine, ignore_index=True) if quarantine else empty_quarantine()
     if all_data:
-        return pd.concat(all_data, ignore_index=True)
+        return pd.concat(all_data, ignore_index=True), quarantine
     else:
-        return pd.DataFrame(columns=["Tail", "FC", "Aircraft_Type", "YearMonth"])
+        return pd.DataFrame(columns=["Tail", "FC", "Aircraft_Type", "YearMonth"]), quarantine
 
 
 
@@ -298,42 +1837,12 @@ from pandas.tseries.offsets import DateOffset
 st.subheader("Operational Reliability")
 
 # FC データ読み込み（既存関数）
-df_fc = load_fc_data()
-
-# Irregular データ（月別・機種別）
-irreg_by_type = (
-    df_irregular.groupby(["YearMonth", "Aircraft_Type"])
-    .size()
-    .reset_index(name="Irreg_Count")
-)
-
-# FC データ（月別・機種別）
-fc_by_type = (
-    df_fc.groupby(["YearMonth", "Aircraft_Type"], as_index=False)["FC"].sum()
-    .rename(columns={"FC": "Total_FC"})
-)
-
-# マージ
-rel_by_type = pd.merge(fc_by_type, irreg_by_type, on=["YearMonth", "Aircraft_Type"], how="left")
-rel_by_type["Irreg_Count"] = rel_by_type["Irreg_Count"].fillna(0)
-
-# Operational Reliability (%)（ゼロ除算対策）
-rel_by_type["Operational_Reliability"] = np.where(
-    rel_by_type["Total_FC"] > 0,
-    ((rel_by_type["Total_FC"] - rel_by_type["Irreg_Count"]) / rel_by_type["Total_FC"]) * 100,
-    np.nan
-)
-
-# Irregular：全機種合計（月別）
-irreg_total = (
-    df_irregular.groupby("YearMonth")
-    .size()
-    .reset_index(name="Irreg_Total")
-)
+df_fc, fc_quarantine = load_fc_data(get_file_version(FC_FILE))
+fc_by_type, tail_rel_matrix = build_fc_reliability(df_irregular, df_fc, DATA_VERSION)
+history_paths["fc"] = build_history_store(df_fc, "fc", get_file_version(FC_FILE))
 
-# YearMonth を datetime に変換
-rel_by_type["YearMonth_dt"] = pd.to_datetime(rel_by_type["YearMonth"], format="%Y-%m", errors="coerce")
-irreg_total["YearMonth_dt"] = pd.to_datetime(irreg_total["YearMonth"], format="%Y-%m", errors="coerce")
+# 機種別 Operational Reliability（月別）と全機種合計のイレギュラー件数（月別）
+rel_by_type, irreg_total = build_reliability_by_type(df_irregular, df_fc, DATA_VERSION)
 
 # 最新日付と直近12か月の範囲
 available_months = pd.concat([rel_by_type["YearMonth_dt"].dropna(), irreg_total["YearMonth_dt"].dropna()])
@@ -360,54 +1869,66 @@ else:
     # NaN を埋める
     rel_by_type_12["Operational_Reliability"] = rel_by_type_12["Operational_Reliability"].fillna(100)
 
-    # グラフ作成
-    fig_rel_type = go.Figure()
-
-    # 機種別折れ線
-    for ac_type, color in zip(["A350-900", "A350-1000"], ["royalblue", "crimson"]):
-        df_plot = rel_by_type_12[rel_by_type_12["Aircraft_Type"] == ac_type]
-        if df_plot.empty:
-            continue
-        fig_rel_type.add_trace(go.Scatter(
-            x=df_plot["YearMonth_dt"],
-            y=df_plot["Operational_Reliability"],
-            mode="lines+markers+text",
-            text=df_plot["Operational_Reliability"].round(2).astype(str) + "%",
-            textposition="top center",
-            textfont=dict(size=12, color="black", family="Arial Black"),
-            name=f"{ac_type} Operational Reliability (%)",
-            line=dict(color=color),
-            yaxis="y1"
-        ))
-
-    # イレギュラー件数（棒グラフ）
-    if not irreg_total_12.empty:
-        fig_rel_type.add_trace(go.Bar(
-            x=irreg_total_12["YearMonth_dt"],
-            y=irreg_total_12["Irreg_Total"],
-            name="イレギュラー件数（全機種）",
-            yaxis="y2",
-            marker=dict(color="lightgrey"),
-            opacity=0.6
-        ))
-
-    # 縦軸レンジを動的調整
-    min_rel = rel_by_type_12["Operational_Reliability"].min()
-    y_lower = 0 if pd.isna(min_rel) else max(0, min(95, (min_rel - 1)))
+    def build_reliability_chart():
+        # グラフ作成
+        fig_rel_type = go.Figure()
 
-    # レイアウト
-    fig_rel_type.update_layout(
-        title="Operational Reliability (%)（機種別） & イレギュラー件数（月別・直近12か月）",
-        xaxis=dict(type="date", title="年月", tickformat="%Y-%m"),
-        yaxis=dict(title="Operational Reliability (%)", side="left", range=[y_lower, 100]),
-        yaxis2=dict(title="イレギュラー件数", overlaying="y", side="right"),
-        barmode="overlay",
-        hovermode="x unified",
-        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0)
-    )
+        # 機種別折れ線
+        for ac_type, df_plot in split_by_type(rel_by_type_12).items():
+            if df_plot.empty:
+                continue
+            fig_rel_type.add_trace(make_line_trace(
+                x=df_plot["YearMonth_dt"],
+                y=df_plot["Operational_Reliability"],
+                render_mode=chart_render_mode,
+                max_points=chart_max_points,
+                mode="lines+markers+text",
+                text=df_plot["Operational_Reliability"].round(2).astype(str) + "%",
+                textposition="top center",
+                textfont=dict(size=12, color="black", family="Arial Black"),
+                name=f"{ac_type} Operational Reliability (%)",
+                line=dict(color=FLEET_TYPES[ac_type]["color"]),
+                yaxis="y1"
+            ))
+
+        # イレギュラー件数（棒グラフ）
+        if not irreg_total_12.empty:
+            fig_rel_type.add_trace(go.Bar(
+                x=irreg_total_12["YearMonth_dt"],
+                y=irreg_total_12["Irreg_Total"],
+                name="イレギュラー件数（全機種）",
+                yaxis="y2",
+                marker=dict(color="lightgrey"),
+                opacity=0.6
+            ))
+
+        # 縦軸レンジを動的調整
+        min_rel = rel_by_type_12["Operational_Reliability"].min()
+        y_lower = 0 if pd.isna(min_rel) else max(0, min(95, (min_rel - 1)))
+
+        # レイアウト
+        fig_rel_type.update_layout(
+            title="Operational Reliability (%)（機種別） & イレギュラー件数（月別・直近12か月）",
+            xaxis=dict(type="date", title="年月", tickformat="%Y-%m"),
+            yaxis=dict(title="Operational Reliability (%)", side="left", range=[y_lower, 100]),
+            yaxis2=dict(title="イレギュラー件数", overlaying="y", side="right"),
+            barmode="overlay",
+            hovermode="x unified",
+            legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0)
+        )
+        return fig_rel_type
 
+    fig_rel_type = cached_figure("reliability", (chart_render_mode, chart_max_points), build_reliability_chart)
     st.plotly_chart(fig_rel_type, use_container_width=True)
 
+    # 機番別 Operational Reliability（直近12か月）
+    with st.expander("機番別 Operational Reliability (%)（直近12か月）"):
+        months_12 = [m for m in tail_rel_matrix.columns if m >= min_dt.strftime("%Y-%m")]
+        st.dataframe(
+            tail_rel_matrix[months_12].style.format("{:.2f}", na_rep="-"),
+            use_container_width=True
+        )
+
 
 # --- Reliability グラフの下にイレギュラー内容の表を追加 ---
 st.subheader("✈Data")
@@ -430,6 +1951,7 @@ df_irregular_sorted = df_irregular_display[irreg_display_cols] \
 
 # 表示（高さ調整のみ）
 st.dataframe(df_irregular_sorted, use_container_width=True, height=500)
+export_panel(df_irregular_sorted, "irregular_events", "export_irregular")
 
 
 # データ範囲を取得
@@ -470,7 +1992,7 @@ start_date, end_date = st.slider(
 )
 
 # 集計関数をキャッシュ
-@st.cache_data
+@st.cache_data(persist="disk", max_entries=DISK_CACHE_MAX_ENTRIES)
 def aggregate_irregular_by_ata(df, start, end):
     df_period = df[(df["Date"].dt.date >= start) & (df["Date"].dt.date <= end)]
     ata_counts = (
@@ -487,31 +2009,123 @@ def aggregate_irregular_by_ata(df, start, end):
 # 集計実行
 ata_counts, categories = aggregate_irregular_by_ata(df_irregular, start_date, end_date)
 
-# 横棒グラフ作成（見やすさ調整）
-fig_bar = go.Figure(go.Bar(
-    x=ata_counts["Count"],
-    y=ata_counts["ATA_SubChapter"].astype(str),
-    orientation="h",
-    marker=dict(color="skyblue"),
-    text=ata_counts["Count"],  # 件数表示
-    textposition="outside"
-))
-
-fig_bar.update_layout(
-    title="イレギュラー件数（ATA別・上位50件）",
-    xaxis_title="件数",
-    yaxis_title="ATA_SubChapter",
-    yaxis=dict(
-        categoryorder="array",
-        categoryarray=categories
-    ),
-    height=min(max(500, len(categories) * 35), 1000),  # 棒を太めに
-    margin=dict(l=120, r=50, t=50, b=50),
-    bargap=0.15  # 棒と棒の間隔
-)
+def build_irregular_ata_chart():
+    # 横棒グラフ作成（見やすさ調整）
+    fig_bar = go.Figure(go.Bar(
+        x=ata_counts["Count"],
+        y=ata_counts["ATA_SubChapter"].astype(str),
+        orientation="h",
+        marker=dict(color="skyblue"),
+        text=ata_counts["Count"],  # 件数表示
+        textposition="outside"
+    ))
+
+    fig_bar.update_layout(
+        title="イレギュラー件数（ATA別・上位50件）",
+        xaxis_title="件数",
+        yaxis_title="ATA_SubChapter",
+        yaxis=dict(
+            categoryorder="array",
+            categoryarray=categories
+        ),
+        height=min(max(500, len(categories) * 35), 1000),  # 棒を太めに
+        margin=dict(l=120, r=50, t=50, b=50),
+        bargap=0.15  # 棒と棒の間隔
+    )
+    return fig_bar
 
+fig_bar = cached_figure("irregular_ata", (start_date, end_date), build_irregular_ata_chart)
 st.plotly_chart(fig_bar, use_container_width=True)
 
+# ================================
+# 🔗 運航影響につながった不具合（イレギュラー ↔ 直前の不具合）
+# ================================
+st.subheader("🔗 Defects that led to operational impact")
+
+link_window = st.slider("イレギュラー発生前の参照期間（日）", min_value=1, max_value=30, value=7, key="link_window")
+linked_events, link_summary = link_irregular_to_defects(df, df_irregular, DATA_VERSION, link_window)
+
+st.dataframe(
+    link_summary.rename(columns={
+        'Events': 'イレギュラー件数',
+        'Linked_Events': '不具合ありイレギュラー件数',
+        'Linked_Defects': '関連不具合件数',
+        'Median_Lead_Days': '不具合→イレギュラー日数（中央値）',
+        'Link_Rate': '関連率(%)'
+    }).round(1),
+    use_container_width=True,
+    hide_index=True,
+    height=350
+)
+
+with st.expander("イレギュラーと直前の不具合の対応一覧"):
+    linked_display = linked_events[linked_events['Defect_ID'].notna()].copy()
+    linked_display['Date'] = linked_display['Date'].dt.strftime('%Y-%m-%d')
+    linked_display['Defect_Date'] = linked_display['Defect_Date'].dt.strftime('%Y-%m-%d')
+    st.dataframe(
+        linked_display[[
+            'Date', 'FLT_Number', 'Tail', 'Aircraft_Type', 'Event_Type', 'ATA_Chapter', 'Description',
+            'Defect_Date', 'MOD_Description', 'Lead_Days', 'Defects_In_Window'
+        ]],
+        use_container_width=True,
+        hide_index=True
+    )
+
+# ================================
+# ⏱ 遅延時間・整備ダウンタイムの分布（分位点スケッチのマージ）
+# ================================
+st.subheader("⏱ Delay / Downtime Percentiles")
+
+delay_sketches = build_delay_sketches(df_irregular, DATA_VERSION)
+sketch_months = sorted(delay_sketches["YearMonth"].unique())
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    sketch_metric_label = st.radio("指標", list(SKETCH_METRICS), horizontal=True, key="sketch_metric")
+with col2:
+    sketch_dim_label = st.radio("集計軸", list(SKETCH_DIMENSIONS), horizontal=True, key="sketch_dim")
+with col3:
+    sketch_start, sketch_end = st.select_slider(
+        "期間",
+        options=sketch_months,
+        value=(sketch_months[max(0, len(sketch_months) - 12)], sketch_months[-1]),
+        key="sketch_months"
+    )
+
+sketch_metric = SKETCH_METRICS[sketch_metric_label]
+sketch_dim = SKETCH_DIMENSIONS[sketch_dim_label]
+percentiles = sketch_quantiles(delay_sketches, sketch_metric, sketch_dim, sketch_start, sketch_end)
+if sketch_dim == "YearMonth":
+    percentiles = percentiles.sort_values("YearMonth")
+else:
+    percentiles = percentiles.sort_values(["p90", "Events"], ascending=False)
+
+def build_percentile_chart():
+    top = percentiles.head(20)
+    fig_pct = go.Figure([
+        go.Bar(name=name, x=top[sketch_dim].astype(str), y=top[name])
+        for name in SKETCH_QUANTILES
+    ])
+    fig_pct.update_layout(
+        barmode="group",
+        title=f"{sketch_metric_label} 分位点（{sketch_dim_label}別、{sketch_start} 〜 {sketch_end}）",
+        xaxis=dict(type="category", title=sketch_dim_label),
+        yaxis_title="分",
+        margin=dict(t=50)
+    )
+    return fig_pct
+
+fig_pct = cached_figure(
+    "delay_percentiles", (sketch_metric, sketch_dim, sketch_start, sketch_end), build_percentile_chart
+)
+st.plotly_chart(fig_pct, use_container_width=True)
+st.dataframe(
+    percentiles.rename(columns={sketch_dim: sketch_dim_label, "Events": "件数"}).round(1),
+    use_container_width=True,
+    hide_index=True,
+    height=300
+)
+
 # ================================
 # ✈ FLT SQ / Pilot Report
 # ================================
@@ -521,199 +2135,306 @@ latest_month = df['YearMonth'].max()
 prev_month = (pd.Period(latest_month, freq='M') - 1).strftime('%Y-%m')
 
 ata_orders = {}  # ATA並び順を保存
-
-col_left, col_right = st.columns(2)
-
-for aircraft, col in zip(['A350-900', 'A350-1000'], [col_left, col_right]):
+ata_latest_prev = {}  # 機種別 ATA件数（当月・前月）
+
+# 当月・前月の件数は ATA 警報テーブル（機種 × ATA × 月の件数、事前計算済み）から引く
+ata_alerts = build_ata_alerts(df, DATA_VERSION)
+ata_alerts_latest = lookup_ata_alerts(ata_alerts, "Chapter", latest_month)
+
+latest_prev_counts = ata_alerts_latest[['Aircraft_Type', 'ATA', 'Count']].merge(
+    lookup_ata_alerts(ata_alerts, "Chapter", prev_month)[['Aircraft_Type', 'ATA', 'Count']],
+    on=['Aircraft_Type', 'ATA'],
+    how='left',
+    suffixes=('', '_Prev')
+).rename(columns={'ATA': 'ATA_Chapter', 'Count': 'Latest_Count', 'Count_Prev': 'Prev_Count'})
+latest_prev_counts['Prev_Count'] = latest_prev_counts['Prev_Count'].fillna(0).astype(int)
+latest_prev_counts = split_by_type(latest_prev_counts[latest_prev_counts['Latest_Count'] > 0])
+
+for aircraft, col in fleet_columns():
     with col:
         st.markdown(f"### ✈ {aircraft}")
-        
-        df_type = df[df['Aircraft_Type'] == aircraft]
 
         # 件数集計
-        latest_counts = df_type[df_type['YearMonth'] == latest_month].groupby('ATA_Chapter').size().reset_index(name='Latest_Count')
-        prev_counts = df_type[df_type['YearMonth'] == prev_month].groupby('ATA_Chapter').size().reset_index(name='Prev_Count')
-        merged = pd.merge(latest_counts, prev_counts, on='ATA_Chapter', how='left').fillna(0)
+        merged = latest_prev_counts[aircraft].drop(columns='Aircraft_Type').reset_index(drop=True)
         merged = merged.sort_values(by='Latest_Count', ascending=False)
+        ata_latest_prev[aircraft] = merged
         ata_orders[aircraft] = merged['ATA_Chapter'].astype(str).tolist()
 
 
 # ================================
-# Top Driver（月別件数推移、過去1年間総件数ベース）
+# Top Driver（月別件数推移、過去1年間総件数ベース）
+# ================================
+col1, col2, col3 = st.columns(3)
+with col1:
+    filter_exclude_top_driver = st.checkbox("Seat/IFE/WiFi以外（Top Driverのみ適用）", value=False)
+with col2:
+    top_driver_key_label = st.radio("ランキング基準", list(TOP_DRIVER_KEYS.keys()), horizontal=True)
+top_driver_key = TOP_DRIVER_KEYS[top_driver_key_label]
+# 直近12か月の各月で12か月窓を取れるよう、履歴ストアから必要な月だけを読む
+top_driver_start = (pd.Period(latest_month, freq="M") - (2 * TOP_DRIVER_WINDOW - 2)).strftime("%Y-%m")
+df_top_driver = read_history_window(history_paths["defects"], top_driver_start, DATA_VERSION)
+top_driver_rankings, top_driver_trends = build_top_driver_rankings(df_top_driver, DATA_VERSION, top_driver_key)
+with col3:
+    top_driver_months = sorted(top_driver_rankings.index.get_level_values("YearMonth").unique(), reverse=True)
+    top_driver_months = top_driver_months[:TOP_DRIVER_WINDOW]
+    top_driver_month = st.selectbox("対象月（直近12か月）", top_driver_months, index=0)
+
+for aircraft_type, col in fleet_columns():
+    with col:
+        # 過去1年間総件数でTop10（事前計算済み）とその月別件数
+        monthly_counts = lookup_top_driver(
+            top_driver_trends, aircraft_type, filter_exclude_top_driver, top_driver_month
+        )[['Month', top_driver_key, 'Count']].rename(columns={'Month': 'YearMonth', 'Count': '件数'})
+
+        def build_top_driver_chart():
+            fig_top = px.line(
+                monthly_counts,
+                x='YearMonth',
+                y='件数',
+                color=top_driver_key,
+                markers=True,
+                render_mode=chart_render_mode
+            )
+            fig_top.update_layout(
+                title=f"{aircraft_type} Top Driver (Top10)",
+                xaxis_title="月",
+                yaxis_title="件数",
+                legend_title=top_driver_key_label,
+                margin=dict(t=50)
+            )
+            return fig_top
+
+        fig_top = cached_figure(
+            "top_driver",
+            (aircraft_type, filter_exclude_top_driver, top_driver_key, top_driver_month, chart_render_mode),
+            build_top_driver_chart
+        )
+        st.plotly_chart(fig_top, use_container_width=True)
+
+# ================================
+# 円グラフ → 件数棒グラフ → 増加率グラフ
 # ================================
-exclude_patterns = ["2520", "2521", "2528"] + \
-                   [f"442{i}" for i in range(10)] + \
-                   [f"443{i}" for i in range(10)]
+ata_alerts_by_type = split_by_type(ata_alerts_latest)
 
-def is_seat_related(row):
-    return (row['ATA_Chapter'] == "0" and "seat" in str(row['MOD_Description']).lower())
+for aircraft, col in fleet_columns():
+    with col:
+        merged = ata_latest_prev[aircraft]
+
+        def build_ata_pie():
+            # 円グラフ
+            counts = merged.sort_values('ATA_Chapter').rename(columns={'Latest_Count': 'Count'})
+            fig_pie = go.Figure(go.Pie(
+                labels=counts['ATA_Chapter'],
+                values=counts['Count'],
+                textinfo='label',
+                hole=0.3
+            ))
+            fig_pie.update_layout(
+                title=f"{aircraft} ATA別比率（{latest_month}）",
+                height=400,
+                margin=dict(t=40, b=0, l=0, r=0)
+            )
+            return fig_pie
 
-filter_exclude_top_driver = st.checkbox("Seat/IFE/WiFi以外（Top Driverのみ適用）", value=False)
+        fig_pie = cached_figure("ata_pie", (aircraft, latest_month), build_ata_pie)
+        st.plotly_chart(fig_pie, use_container_width=True)
 
-one_year_ago = (pd.Period(latest_month, freq='M') - 11).strftime('%Y-%m')
-df_recent_1y_top = df[df['YearMonth'] >= one_year_ago]
+        def build_ata_count():
+            # 棒グラフ（件数）
+            fig_count = go.Figure(data=[
+                go.Bar(
+                    name=f"{latest_month}",
+                    x=merged['ATA_Chapter'],
+                    y=merged['Latest_Count'],
+                    marker_color='steelblue',
+                    text=merged['Latest_Count'],
+                    textposition='outside'
+                ),
+                go.Bar(
+                    name=f"{prev_month}",
+                    x=merged['ATA_Chapter'],
+                    y=merged['Prev_Count'],
+                    marker_color='lightcoral',
+                    text=merged['Prev_Count'],
+                    textposition='outside'
+                )
+            ])
+            fig_count.update_layout(
+                barmode='group',
+                title=f"ATA別不具合件数（{latest_month} と {prev_month}）",
+                xaxis_title="ATA Chapter",
+                yaxis_title="件数",
+                xaxis=dict(type='category'),
+                bargap=0.2,
+                margin=dict(t=50)
+            )
+            return fig_count
 
-if filter_exclude_top_driver:
-    df_recent_1y_top = df_recent_1y_top[
-        (~df_recent_1y_top['ATA_SubChapter'].isin(exclude_patterns)) &
-        (~df_recent_1y_top.apply(is_seat_related, axis=1))
-    ]
+        fig_count = cached_figure("ata_count", (aircraft, latest_month, prev_month), build_ata_count)
+        st.plotly_chart(fig_count, use_container_width=True)
 
-col_a, col_b = st.columns(2)
-for col, aircraft_type in zip([col_a, col_b], ["A350-900", "A350-1000"]):
-    with col:
-        df_td = df_recent_1y_top[df_recent_1y_top['Aircraft_Type'] == aircraft_type]
+        def build_ata_rate():
+            # 増加率グラフ（警報エンジンの計算結果から参照）
+            rate_src = ata_alerts_by_type[aircraft]
+            rate_df = pd.DataFrame({
+                'ATA_Chapter': rate_src['ATA'].values,
+                '短期増加率(%)': rate_src['Short_Rate'].round(1).values,
+                '長期増加率(%)': rate_src['Long_Rate'].round(1).values
+            })
+
+            if aircraft in ata_orders:
+                rate_df['ATA_Chapter'] = pd.Categorical(
+                    rate_df['ATA_Chapter'],
+                    categories=ata_orders[aircraft],
+                    ordered=True
+                )
+                rate_df = rate_df.sort_values('ATA_Chapter').reset_index(drop=True)
+
+            fig_rate = go.Figure(data=[
+                go.Bar(
+                    name='短期増加率(%)',
+                    x=rate_df['ATA_Chapter'],
+                    y=rate_df['短期増加率(%)'],
+                    marker_color='orange'
+                ),
+                go.Bar(
+                    name='長期増加率(%)',
+                    x=rate_df['ATA_Chapter'],
+                    y=rate_df['長期増加率(%)'],
+                    marker_color='green'
+                )
+            ])
+            fig_rate.update_layout(
+                barmode='group',
+                title=f"増加率 (%)（{latest_month}）",
+                xaxis_title="ATA Chapter",
+                yaxis_title="増加率(%)",
+                xaxis=dict(type='category'),
+                bargap=0.2,
+                margin=dict(t=30)
+            )
+            return fig_rate
 
-        # 過去1年間総件数でTop10
-        top_mod_list = (
-            df_td.groupby('MOD_Description')
-            .size()
-            .sort_values(ascending=False)
-            .head(10)
-            .index.tolist()
-        )
+        fig_rate = cached_figure("ata_rate", (aircraft, latest_month), build_ata_rate)
+        st.plotly_chart(fig_rate, use_container_width=True)
 
-        df_top = df_td[df_td['MOD_Description'].isin(top_mod_list)]
-        monthly_counts = (
-            df_top.groupby(['YearMonth', 'MOD_Description'])
-            .size()
-            .reset_index(name='件数')
-        )
+# ================================
+# 🚨 ATA 警報（平均 + kσ 超過の一覧）
+# ================================
+st.subheader("🚨 ATA Alert")
 
-        fig_top = px.line(
-            monthly_counts,
-            x='YearMonth',
-            y='件数',
-            color='MOD_Description',
-            markers=True
-        )
-        fig_top.update_layout(
-            title=f"{aircraft_type} Top Driver (Top10)",
-            xaxis_title="月",
-            yaxis_title="件数",
-            legend_title="不具合内容",
-            margin=dict(t=50)
-        )
-        st.plotly_chart(fig_top, use_container_width=True)
+alert_months = sorted(ata_alerts.index.get_level_values("YearMonth").unique(), reverse=True)
+col1, col2, col3, col4 = st.columns(4)
+with col1:
+    alert_month = st.selectbox("対象月", alert_months, index=0)
+with col2:
+    alert_level = st.radio("集計単位", list(ATA_ALERT_LEVELS.keys()), horizontal=True)
+with col3:
+    alert_k = st.slider("警報係数 k（平均 + kσ）", min_value=1.0, max_value=4.0, value=2.0, step=0.5)
+with col4:
+    alert_window = st.slider("参照期間（か月）", min_value=3, max_value=12, value=6)
+
+alerts_month = lookup_ata_alerts(build_ata_alerts(df, DATA_VERSION, alert_window, alert_k), alert_level, alert_month)
+exceed_list = (
+    alerts_month[alerts_month['Exceeded']]
+    .sort_values(['Sigma', 'Count'], ascending=False)
+    .reset_index(drop=True)
+)
+
+st.markdown(f"🔢 **警報件数：{len(exceed_list)} 件**（{alert_month}）")
+st.dataframe(
+    exceed_list[['Aircraft_Type', 'ATA', 'Count', 'Alert_Level', 'Sigma', 'MA', 'Short_Rate', 'Long_Rate']]
+    .rename(columns={
+        'Count': '件数',
+        'Alert_Level': '警報レベル',
+        'Sigma': '超過(σ)',
+        'MA': '移動平均',
+        'Short_Rate': '短期増加率(%)',
+        'Long_Rate': '長期増加率(%)'
+    })
+    .round(2),
+    use_container_width=True,
+    hide_index=True
+)
 
 # ================================
-# 円グラフ → 件数棒グラフ → 増加率グラフ
+# 🔮 ATA 件数予測（今後3か月）
 # ================================
-col_left, col_right = st.columns(2)
-for aircraft, col in zip(['A350-900', 'A350-1000'], [col_left, col_right]):
-    with col:
-        
-        df_type_ata = df[df['Aircraft_Type'] == aircraft]
-
-        latest_counts = df_type_ata[df_type_ata['YearMonth'] == latest_month].groupby('ATA_Chapter').size().reset_index(name='Latest_Count')
-        prev_counts = df_type_ata[df_type_ata['YearMonth'] == prev_month].groupby('ATA_Chapter').size().reset_index(name='Prev_Count')
-        merged = pd.merge(latest_counts, prev_counts, on='ATA_Chapter', how='left').fillna(0)
-        merged = merged.sort_values(by='Latest_Count', ascending=False)
-        ata_orders[aircraft] = merged['ATA_Chapter'].astype(str).tolist()
+st.subheader("🔮 ATA Forecast")
 
-        # 円グラフ
-        counts = df_type_ata[df_type_ata['YearMonth'] == latest_month].groupby('ATA_Chapter').size().reset_index(name='Count')
-        fig_pie = go.Figure(go.Pie(
-            labels=counts['ATA_Chapter'],
-            values=counts['Count'],
-            textinfo='label',
-            hole=0.3
-        ))
-        fig_pie.update_layout(
-            title=f"{aircraft} ATA別比率（{latest_month}）",
-            height=400,
-            margin=dict(t=40, b=0, l=0, r=0)
-        )
-        st.plotly_chart(fig_pie, use_container_width=True)
+ata_forecasts, forecast_counts = forecast_ata_counts(df, df_irregular, DATA_VERSION)
+col1, col2, col3 = st.columns(3)
+with col1:
+    forecast_source_label = st.radio("対象", list(FORECAST_SOURCES), horizontal=True, key="forecast_source")
+with col2:
+    forecast_level = st.radio("集計単位", list(ATA_ALERT_LEVELS.keys()), horizontal=True, key="forecast_level")
+with col3:
+    forecast_type = st.selectbox("機種", FLEET_TYPE_NAMES, key="forecast_type")
+
+forecast_source = FORECAST_SOURCES[forecast_source_label]
+forecast_key = (forecast_source, forecast_level)
+forecast_view = ata_forecasts.loc[[forecast_key]] if forecast_key in ata_forecasts.index else ata_forecasts.iloc[:0]
+forecast_view = forecast_view[forecast_view["Aircraft_Type"] == forecast_type]
+forecast_months = sorted(forecast_view["Forecast_Month"].unique())
+forecast_table = (
+    forecast_view[forecast_view["Horizon"] == 1][["ATA", "Last_Count", "Expected", "Lower", "Upper"]]
+    .sort_values(["Expected", "Last_Count"], ascending=False)
+    .reset_index(drop=True)
+)
 
-        # 棒グラフ（件数）
-        fig_count = go.Figure(data=[
-            go.Bar(
-                name=f"{latest_month}",
-                x=merged['ATA_Chapter'],
-                y=merged['Latest_Count'],
-                marker_color='steelblue',
-                text=merged['Latest_Count'],
-                textposition='outside'
-            ),
-            go.Bar(
-                name=f"{prev_month}",
-                x=merged['ATA_Chapter'],
-                y=merged['Prev_Count'],
-                marker_color='lightcoral',
-                text=merged['Prev_Count'],
-                textposition='outside'
-            )
-        ])
-        fig_count.update_layout(
-            barmode='group',
-            title=f"ATA別不具合件数（{latest_month} と {prev_month}）",
-            xaxis_title="ATA Chapter",
-            yaxis_title="件数",
-            xaxis=dict(type='category'),
-            bargap=0.2,
-            margin=dict(t=50)
-        )
-        st.plotly_chart(fig_count, use_container_width=True)
+lo_pct, hi_pct = (int(q * 100) for q in FORECAST_INTERVAL)
+if forecast_months:
+    st.markdown(
+        f"🔢 **{forecast_months[0]} 〜 {forecast_months[-1]}** の月あたり期待件数（EWMA 水準）と "
+        f"{lo_pct}〜{hi_pct}% 予測区間（ポアソン）"
+    )
+st.dataframe(
+    forecast_table.rename(columns={
+        'Last_Count': '直近月 件数',
+        'Expected': '予測件数/月',
+        'Lower': f'下限({lo_pct}%)',
+        'Upper': f'上限({hi_pct}%)'
+    }).round(2),
+    use_container_width=True,
+    hide_index=True,
+    height=300
+)
 
-        # 増加率グラフ
-        ata_monthly = df_type_ata.groupby(['YearMonth', 'ATA_Chapter']).size().unstack(fill_value=0).sort_index()
+forecast_ata = st.selectbox("推移を表示する ATA", forecast_table["ATA"].tolist(), key="forecast_ata")
 
-        if latest_month in ata_monthly.index and prev_month in ata_monthly.index:
-            latest_c = ata_monthly.loc[latest_month]
-            prev_c = ata_monthly.loc[prev_month]
-            short_term_rate = ((latest_c - prev_c) / prev_c.replace(0, pd.NA)) * 100
-            short_term_rate = pd.to_numeric(short_term_rate, errors='coerce').fillna(0)
-        else:
-            short_term_rate = pd.Series(0, index=ata_monthly.columns)
-
-        ata_ma6 = ata_monthly.rolling(window=6, min_periods=2).mean()
-        if latest_month in ata_ma6.index and prev_month in ata_ma6.index:
-            latest_ma = ata_ma6.loc[latest_month]
-            prev_ma = ata_ma6.loc[prev_month]
-            long_term_rate = ((latest_ma - prev_ma) / prev_ma.replace(0, pd.NA)) * 100
-            long_term_rate = pd.to_numeric(long_term_rate, errors='coerce').fillna(0)
-        else:
-            long_term_rate = pd.Series(0, index=ata_monthly.columns)
-
-        rate_df = pd.DataFrame({
-            'ATA_Chapter': ata_monthly.columns.astype(str),
-            '短期増加率(%)': short_term_rate.round(1),
-            '長期増加率(%)': long_term_rate.round(1)
-        }).reset_index(drop=True)
-
-        if aircraft in ata_orders:
-            rate_df['ATA_Chapter'] = pd.Categorical(
-                rate_df['ATA_Chapter'],
-                categories=ata_orders[aircraft],
-                ordered=True
-            )
-            rate_df = rate_df.sort_values('ATA_Chapter').reset_index(drop=True)
+def build_forecast_chart():
+    # 実績は予測に使った件数行列（直近12か月）から参照
+    actual = forecast_counts[forecast_key][(forecast_type, forecast_ata)].iloc[-12:]
+    future = forecast_view[forecast_view["ATA"] == forecast_ata]
 
-        fig_rate = go.Figure(data=[
-            go.Bar(
-                name='短期増加率(%)',
-                x=rate_df['ATA_Chapter'],
-                y=rate_df['短期増加率(%)'],
-                marker_color='orange'
-            ),
-            go.Bar(
-                name='長期増加率(%)',
-                x=rate_df['ATA_Chapter'],
-                y=rate_df['長期増加率(%)'],
-                marker_color='green'
-            )
-        ])
-        fig_rate.update_layout(
-            barmode='group',
-            title=f"増加率 (%)（{latest_month}）",
-            xaxis_title="ATA Chapter",
-            yaxis_title="増加率(%)",
-            xaxis=dict(type='category'),
-            bargap=0.2,
-            margin=dict(t=30)
+    fig_fc = go.Figure()
+    fig_fc.add_trace(go.Bar(x=actual.index, y=actual.values, name="実績", marker_color="steelblue"))
+    fig_fc.add_trace(go.Scatter(
+        x=future["Forecast_Month"],
+        y=future["Expected"],
+        name="予測",
+        mode="lines+markers",
+        line=dict(color="orange", dash="dash"),
+        error_y=dict(
+            type="data",
+            symmetric=False,
+            array=future["Upper"] - future["Expected"],
+            arrayminus=future["Expected"] - future["Lower"]
         )
-        st.plotly_chart(fig_rate, use_container_width=True)
+    ))
+    fig_fc.update_layout(
+        title=f"{forecast_type} ATA{forecast_ata} {forecast_source_label}件数 実績と予測",
+        xaxis=dict(type="category", title="年月"),
+        yaxis_title="件数",
+        margin=dict(t=50)
+    )
+    return fig_fc
+
+if forecast_ata is not None:
+    fig_fc = cached_figure(
+        "ata_forecast", (forecast_source, forecast_level, forecast_type, forecast_ata), build_forecast_chart
+    )
+    st.plotly_chart(fig_fc, use_container_width=True)
 
 
 
@@ -758,92 +2479,97 @@ latest_date = df['Reported_Date'].max()
 one_year_ago = latest_date - DateOffset(years=1)
 
 # 不具合データ（直近1年間）
-df_recent = df[df['Reported_Date'] >= one_year_ago]
+df_recent = read_history_window(history_paths["defects"], one_year_ago.strftime('%Y-%m'), DATA_VERSION)
+df_recent = df_recent[df_recent['Reported_Date'] >= one_year_ago]
 
-# 月別・ATA別件数
-ata_monthly = df_recent.groupby(['ATA_Chapter', 'YearMonth']).size().reset_index(name='Count')
-ata_monthly_sum = ata_monthly.groupby('ATA_Chapter')['Count'].sum().reset_index()
-ata_monthly_sorted = ata_monthly_sum.sort_values(by='Count', ascending=False)
+# ドリルダウン索引（ATA → サブチャプター → 機番、データ版ごとに1回構築）
+drilldown_index = build_drilldown_index(df_recent, DATA_VERSION)
 
-# ATA選択
+# ATA選択（件数降順）
 selected_ata = st.selectbox(
     "📌 ATA Chapter",
-    ata_monthly_sorted['ATA_Chapter'].tolist(),
+    drilldown_index["ata_options"],
     index=0
 )
 
 # ==== 左右共通のサブチャプター順序と色を作成 ====
-all_subchapters = sorted(df_recent[df_recent['ATA_Chapter'] == selected_ata]['ATA_SubChapter'].unique())
+all_subchapters = drilldown_index["ata_subchapters"].get(selected_ata, [])
 base_colors = px.colors.qualitative.Plotly
 color_map = {sub: base_colors[i % len(base_colors)] for i, sub in enumerate(all_subchapters)}
 
-col_900, col_1000 = st.columns(2)
-
-for aircraft, col in zip(["A350-900", "A350-1000"], [col_900, col_1000]):
+for aircraft, col in fleet_columns():
     with col:
         # 該当ATA & 機種データ
-        ata_month = df_recent[(df_recent['ATA_Chapter'] == selected_ata) &
-                              (df_recent['Aircraft_Type'] == aircraft)]
-
-        # 月別不具合件数（1年分）
-        monthly_trend = ata_month.groupby('YearMonth').size().reset_index(name='Count')
-
-        # FCデータ（FC比は存在する月だけ計算）
-        fc_monthly = df_fc[df_fc['Aircraft_Type'] == aircraft].groupby('YearMonth')['FC'].sum().reset_index()
-        merged = pd.merge(monthly_trend, fc_monthly, on='YearMonth', how='left')
-        merged['FC比'] = merged.apply(lambda r: r['Count'] / r['FC'] if pd.notna(r['FC']) else None, axis=1)
-
-        # 件数＋FC比グラフ
-        fig = go.Figure()
-        fig.add_trace(go.Bar(
-            x=merged['YearMonth'],
-            y=merged['Count'],
-            name='件数',
-            marker_color='steelblue'
-        ))
-        fig.add_trace(go.Scatter(
-            x=merged['YearMonth'],
-            y=merged['FC比'],
-            name='FC比',
-            mode='lines+markers',
-            yaxis='y2',
-            marker_color='orange'
-        ))
-        fig.update_layout(
-            title=f"{aircraft} ATA{selected_ata} 月別件数 & FC比",
-            xaxis_title="年月",
-            yaxis=dict(title="件数"),
-            yaxis2=dict(title="FC比", overlaying="y", side="right"),
-            hovermode="x unified",
-            margin=dict(t=50)
-        )
+        ata_month = drilldown_rows(drilldown_index, aircraft, selected_ata)
+
+        def build_ata_fc_chart():
+            # 月別不具合件数 & FC比（1年分）
+            # 件数は隣のサブチャプター別グラフと同じ行（one_year_ago 以降）から数え、FC は機種の月間合計（事前計算済み）を引く
+            fc_by_month = fc_by_type.get(aircraft, pd.Series(dtype=float, name='FC'))
+            merged = ata_month.groupby('YearMonth').size().rename('Count').to_frame().join(fc_by_month).reset_index()
+            merged['FC比'] = merged['Count'] / merged['FC'].where(merged['FC'] > 0)
+
+            # 件数＋FC比グラフ
+            fig = go.Figure()
+            fig.add_trace(go.Bar(
+                x=merged['YearMonth'],
+                y=merged['Count'],
+                name='件数',
+                marker_color='steelblue'
+            ))
+            fig.add_trace(make_line_trace(
+                x=merged['YearMonth'],
+                y=merged['FC比'],
+                render_mode=chart_render_mode,
+                max_points=chart_max_points,
+                name='FC比',
+                mode='lines+markers',
+                yaxis='y2',
+                marker_color='orange'
+            ))
+            fig.update_layout(
+                title=f"{aircraft} ATA{selected_ata} 月別件数 & FC比",
+                xaxis_title="年月",
+                yaxis=dict(title="件数"),
+                yaxis2=dict(title="FC比", overlaying="y", side="right"),
+                hovermode="x unified",
+                margin=dict(t=50)
+            )
+            return fig
+
+        fig = cached_figure("ata_fc", (aircraft, selected_ata, chart_render_mode, chart_max_points), build_ata_fc_chart)
         st.plotly_chart(fig, use_container_width=True)
 
-        # ==== サブチャプター別月別件数 ====
-        sub_trend = ata_month.groupby(['YearMonth', 'ATA_SubChapter']).size().reset_index(name='Count')
+        def build_ata_sub_chart():
+            # ==== サブチャプター別月別件数 ====
+            sub_trend = ata_month.groupby(['YearMonth', 'ATA_SubChapter']).size().reset_index(name='Count')
 
-        # 順序固定（左右で同じ順序）
-        sub_trend['ATA_SubChapter'] = pd.Categorical(
-            sub_trend['ATA_SubChapter'],
-            categories=all_subchapters,
-            ordered=True
-        )
+            # 順序固定（左右で同じ順序）
+            sub_trend['ATA_SubChapter'] = pd.Categorical(
+                sub_trend['ATA_SubChapter'],
+                categories=all_subchapters,
+                ordered=True
+            )
 
-        fig_sub = px.line(
-            sub_trend,
-            x='YearMonth',
-            y='Count',
-            color='ATA_SubChapter',
-            markers=True,
-            title=f"{aircraft} ATA{selected_ata} サブチャプター別月別件数",
-            color_discrete_map=color_map
-        )
-        fig_sub.update_layout(
-            xaxis_title="年月",
-            yaxis_title="件数",
-            hovermode="x unified",
-            margin=dict(t=50)
-        )
+            fig_sub = px.line(
+                sub_trend,
+                x='YearMonth',
+                y='Count',
+                color='ATA_SubChapter',
+                markers=True,
+                title=f"{aircraft} ATA{selected_ata} サブチャプター別月別件数",
+                color_discrete_map=color_map,
+                render_mode=chart_render_mode
+            )
+            fig_sub.update_layout(
+                xaxis_title="年月",
+                yaxis_title="件数",
+                hovermode="x unified",
+                margin=dict(t=50)
+            )
+            return fig_sub
+
+        fig_sub = cached_figure("ata_sub", (aircraft, selected_ata, chart_render_mode), build_ata_sub_chart)
         st.plotly_chart(fig_sub, use_container_width=True)
 
 
@@ -851,24 +2577,27 @@ for aircraft, col in zip(["A350-900", "A350-1000"], [col_900, col_1000]):
 # --- サブチャプター選択と不具合詳細表示 ---
 st.subheader("🔍 Breakdown by Subchapter")
 
-subchapter_counts = ata_month['ATA_SubChapter'].value_counts().reset_index()
-subchapter_counts.columns = ['ATA_SubChapter', 'Count']
-
-selected_sub = st.selectbox("Select Subchapter（Sorted by number）", subchapter_counts['ATA_SubChapter'].tolist())
-
-sub_df = ata_month[ata_month['ATA_SubChapter'] == selected_sub].copy()
+# 候補・該当行はすべてドリルダウン索引から直接参照（選択した機種・ATA 配下）
+breakdown_type = st.selectbox("✈ Aircraft Type", FLEET_TYPE_NAMES, index=0, key="breakdown_type")
+selected_sub = st.selectbox(
+    "Select Subchapter（Sorted by number）",
+    drilldown_index["sub_options"].get((breakdown_type, selected_ata), [])
+)
 
 # Tailでフィルター可能なインターフェースを追加
-unique_tails = sorted(sub_df['Tail'].dropna().unique())
+unique_tails = drilldown_index["tail_options"].get((breakdown_type, selected_ata, selected_sub), [])
 tail_filter = st.selectbox("✈️ Select Tail Number", options=["すべて"] + unique_tails)
 
 if tail_filter != "すべて":
-    sub_df = sub_df[sub_df['Tail'] == tail_filter]
+    sub_df = drilldown_rows(drilldown_index, breakdown_type, selected_ata, selected_sub, tail_filter).copy()
+else:
+    sub_df = drilldown_rows(drilldown_index, breakdown_type, selected_ata, selected_sub).copy()
 
 sub_df_display = sub_df[['ATA_SubChapter', 'Reported_Date_Only', 'Tail', 'MOD_Description', 'Corrective_Action']]
 sub_df_display = sub_df_display.sort_values(by='Reported_Date_Only', ascending=False)
 
 st.dataframe(sub_df_display, use_container_width=True, hide_index=True)
+export_panel(sub_df_display, "subchapter_breakdown", "export_subchapter")
 
 # -------------------------------
 # 🔢 サブチャプター内 不具合内容別件数推移（折れ線グラフ）
@@ -901,7 +2630,8 @@ if not sub_df.empty:
             color='MOD_Description',
             markers=True,
             title=f"📈 サブチャプター {selected_sub} 内 不具合内容別 月次件数推移（上位5種類）",
-            labels={'Count': '件数', 'MOD_Description': '不具合内容'}
+            labels={'Count': '件数', 'MOD_Description': '不具合内容'},
+            render_mode=chart_render_mode
         )
         fig_fault_trend.update_layout(
             xaxis_title="年月",
@@ -919,38 +2649,203 @@ else:
 # -------------------------------
 st.markdown("#### サブチャプター別 機番ごとの積み上げ棒グラフ")
 
-col_a, col_b = st.columns(2)
-
-for aircraft, col in zip(["A350-900", "A350-1000"], [col_a, col_b]):
+for aircraft, col in fleet_columns():
     with col:
-        # 選択されたサブチャプター＆機種のデータ抽出
-        df_sub_tail = df_recent[
-            (df_recent['ATA_SubChapter'] == selected_sub) &
-            (df_recent['Aircraft_Type'] == aircraft)
-        ]
-
-        # 月別・機番ごとの件数集計
-        tail_monthly = (
-            df_sub_tail.groupby(['YearMonth', 'Tail']).size().reset_index(name='Count')
-        )
+        def build_tail_chart():
+            # 選択されたサブチャプター＆機種のデータ抽出（サブチャプターは選択中の ATA 配下）
+            df_sub_tail = drilldown_rows(drilldown_index, aircraft, selected_ata, selected_sub)
 
-        # 積み上げ棒グラフ作成
-        fig_tail = px.bar(
-            tail_monthly,
-            x='YearMonth',
-            y='Count',
-            color='Tail',
-            title=f"{aircraft} ATA Subchapter {selected_sub} 月別件数（Tail別）",
-            barmode='stack'
-        )
-        fig_tail.update_layout(
-            xaxis_title="年月",
-            yaxis_title="件数",
-            hovermode="x unified",
-            margin=dict(t=50)
-        )
+            # 月別・機番ごとの件数集計
+            tail_monthly = (
+                df_sub_tail.groupby(['YearMonth', 'Tail']).size().reset_index(name='Count')
+            )
+
+            # 積み上げ棒グラフ作成
+            fig_tail = px.bar(
+                tail_monthly,
+                x='YearMonth',
+                y='Count',
+                color='Tail',
+                title=f"{aircraft} ATA Subchapter {selected_sub} 月別件数（Tail別）",
+                barmode='stack'
+            )
+            fig_tail.update_layout(
+                xaxis_title="年月",
+                yaxis_title="件数",
+                hovermode="x unified",
+                margin=dict(t=50)
+            )
+            return fig_tail
+
+        fig_tail = cached_figure("sub_tail", (aircraft, selected_sub), build_tail_chart)
         st.plotly_chart(fig_tail, use_container_width=True)
 
+# -------------------------------
+# 📌 保存ビューの登録・削除（データ版が変わったビューはここでバックグラウンド更新を開始）
+# -------------------------------
+schedule_view_refresh(saved_views, df, df_irregular, DATA_VERSION)
+
+with st.expander("📌 現在の選択を保存ビューとして登録"):
+    with st.form("save_view_form"):
+        view_name = st.text_input("ビュー名")
+        view_types = [VIEW_ALL] + FLEET_TYPE_NAMES
+        view_aircraft = st.selectbox("機種", view_types, index=view_types.index(breakdown_type))
+        st.caption(f"ATA: {selected_ata} / サブチャプター: {selected_sub or VIEW_ALL} / 機番: {tail_filter}")
+        view_period = st.date_input("期間", value=(one_year_ago.date(), latest_date.date()))
+        view_exclude = st.checkbox("Seat/IFE/WiFiを除く", value=filter_exclude_graph)
+        view_submitted = st.form_submit_button("保存")
+
+    if view_submitted:
+        if not view_name.strip() or len(view_period) != 2:
+            st.warning("ビュー名と期間（開始日・終了日）を指定してください。")
+        else:
+            saved_views[view_name.strip()] = {
+                "aircraft": view_aircraft,
+                "ata": selected_ata,
+                "sub": selected_sub or VIEW_ALL,
+                "tail": tail_filter,
+                "start": view_period[0].isoformat(),
+                "end": view_period[1].isoformat(),
+                "exclude_cabin": view_exclude,
+            }
+            save_saved_views(saved_views)
+            schedule_view_refresh(saved_views, df, df_irregular, DATA_VERSION)
+            st.rerun()
+
+    if saved_views:
+        view_to_delete = st.selectbox("削除するビュー", list(saved_views), key="delete_view")
+        if st.button("削除", key="delete_view_run"):
+            deleted_view = saved_views.pop(view_to_delete)
+            save_saved_views(saved_views)
+            discard_view_result(saved_views, view_digest(deleted_view))
+            st.rerun()
+
+# -------------------------------
+# 🗺 機番 × ATA ヒートマップ（累積行列の差分、FC 正規化・外れ機番の強調）
+# -------------------------------
+st.subheader("🗺 Tail × ATA Heatmap")
+
+col1, col2, col3 = st.columns(3)
+with col1:
+    heatmap_level = st.radio("集計単位", list(ATA_ALERT_LEVELS.keys()), horizontal=True, key="heatmap_level")
+tail_ata = build_tail_ata_cumulative(df, df_fc, DATA_VERSION, ATA_ALERT_LEVELS[heatmap_level])
+heatmap_months = list(tail_ata["months"])
+with col2:
+    heatmap_start, heatmap_end = st.select_slider(
+        "期間",
+        options=heatmap_months,
+        value=(heatmap_months[max(0, len(heatmap_months) - 12)], heatmap_months[-1]),
+        key="heatmap_months"
+    )
+with col3:
+    heatmap_per_fc = st.checkbox("1000FCあたりに正規化", value=True, key="heatmap_per_fc")
+
+def build_tail_ata_heatmap():
+    counts, fc = tail_ata_window(tail_ata, heatmap_start, heatmap_end)
+
+    # 対象機番（FC 正規化時は FC のある機番のみ）を機種 → 機番順、ATA は期間内件数の上位
+    tail_mask = np.isin(tail_ata["tail_types"], FLEET_TYPE_NAMES) & ((fc > 0) if heatmap_per_fc else True)
+    tail_order = np.flatnonzero(tail_mask)
+    tail_order = tail_order[np.lexsort((tail_ata["tails"][tail_order], tail_ata["tail_types"][tail_order]))]
+    ata_totals = counts[tail_order].sum(axis=0)
+    ata_order = np.sort(np.argsort(-ata_totals, kind="stable")[:min(HEATMAP_MAX_ATA, int((ata_totals > 0).sum()))])
+
+    window_counts = counts[np.ix_(tail_order, ata_order)]
+    values = window_counts / fc[tail_order, None] * 1000 if heatmap_per_fc else window_counts.astype(float)
+
+    # 外れ機番：ATA ごとに機番間の平均 + kσ を超え、件数も一定以上
+    mean = values.mean(axis=0)
+    std = values.std(axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sigma = np.where(std > 0, (values - mean) / std, 0)
+    outliers = np.argwhere((sigma > HEATMAP_OUTLIER_SIGMA) & (window_counts >= HEATMAP_OUTLIER_MIN_COUNT))
+
+    tails = tail_ata["tails"][tail_order]
+    atas = tail_ata["atas"][ata_order]
+    fig_heat = go.Figure(go.Heatmap(
+        z=values,
+        x=atas,
+        y=tails,
+        customdata=window_counts,
+        colorscale="YlOrRd",
+        colorbar=dict(title="/1000FC" if heatmap_per_fc else "件数"),
+        hovertemplate="機番 %{y}<br>ATA %{x}<br>値 %{z:.2f}<br>件数 %{customdata}<extra></extra>"
+    ))
+    fig_heat.add_trace(go.Scatter(
+        x=atas[outliers[:, 1]],
+        y=tails[outliers[:, 0]],
+        mode="markers",
+        marker=dict(symbol="circle-open", size=14, color="black", line=dict(width=2)),
+        name=f"外れ値（平均 + {HEATMAP_OUTLIER_SIGMA}σ 超）",
+        hoverinfo="skip"
+    ))
+    fig_heat.update_layout(
+        title=f"機番 × ATA {'1000FCあたり件数' if heatmap_per_fc else '件数'}（{heatmap_start} 〜 {heatmap_end}）",
+        xaxis=dict(type="category", title="ATA"),
+        yaxis=dict(type="category", title="機番", autorange="reversed"),
+        height=max(400, len(tails) * 22 + 150),
+        legend=dict(orientation="h", yanchor="bottom", y=1.02, xanchor="left", x=0),
+        margin=dict(t=80)
+    )
+    return fig_heat
+
+fig_heat = cached_figure(
+    "tail_ata_heatmap", (heatmap_level, heatmap_start, heatmap_end, heatmap_per_fc), build_tail_ata_heatmap
+)
+st.plotly_chart(fig_heat, use_container_width=True)
+
+# -------------------------------
+# 🔁 繰り返し不具合（同一機番・同一サブチャプター）
+# -------------------------------
+st.subheader("🔁 Repeat Defects")
+
+col1, col2 = st.columns(2)
+with col1:
+    repeat_basis_label = st.radio("判定基準", list(REPEAT_BASIS.keys()), horizontal=True, key="repeat_basis")
+repeat_basis = REPEAT_BASIS[repeat_basis_label]
+with col2:
+    repeat_window = st.number_input(
+        f"判定期間（{repeat_basis_label}以内）",
+        min_value=1,
+        max_value=365 if repeat_basis == "Days" else 1000,
+        value=10 if repeat_basis == "Days" else 20,
+        key=f"repeat_window_{repeat_basis}"
+    )
+
+repeat_rows, repeat_items = detect_repeat_defects(df, df_fc, DATA_VERSION, repeat_basis, repeat_window)
+
+st.markdown(f"🔢 **繰り返し項目：{len(repeat_items)} 件**")
+st.dataframe(
+    repeat_items.rename(columns={
+        'Repeats': '繰り返し件数',
+        'Defects': '総件数',
+        'Max_In_Window': '期間内最大件数',
+        'Min_Gap': f'最短間隔（{repeat_basis_label}）',
+        'Last_Date': '最終発生日'
+    }).round(1),
+    use_container_width=True,
+    hide_index=True,
+    height=350
+)
+
+if not repeat_items.empty:
+    repeat_options = (repeat_items['Tail'] + " / " + repeat_items['ATA_SubChapter']).tolist()
+    selected_repeat = st.selectbox("🔍 繰り返し項目を選択", repeat_options)
+    repeat_tail, repeat_sub = selected_repeat.split(" / ")
+
+    repeat_detail = repeat_rows[
+        (repeat_rows['Tail'] == repeat_tail) & (repeat_rows['ATA_SubChapter'] == repeat_sub)
+    ]
+    repeat_detail = repeat_detail.assign(Reported_Date_Only=repeat_detail['Reported_Date'].dt.date)
+    st.dataframe(
+        repeat_detail[['Reported_Date_Only', 'Tail', 'ATA_SubChapter', 'MOD_Description', 'Corrective_Action', 'Gap', 'Is_Repeat']]
+        .rename(columns={'Gap': f'前回からの間隔（{repeat_basis_label}）', 'Is_Repeat': '繰り返し'})
+        .sort_values('Reported_Date_Only', ascending=False)
+        .round(1),
+        use_container_width=True,
+        hide_index=True
+    )
+
 
 # -------------------------------
 # ⑤ 部品（P/N）検索と履歴（履歴一覧表示 + 件数 + 日付絞り込み）
@@ -999,6 +2894,7 @@ st.markdown(f"🔢 **検索結果：{record_count} 件**")
 # 表表示
 st.markdown("📋 **交換履歴一覧**")
 st.dataframe(history_table, use_container_width=True, hide_index=True)
+export_panel(history_table, "pn_history", "export_pn")
 
 # -------------------------------
 # 📊 PN検索時の積み上げ棒グラフ
@@ -1033,7 +2929,214 @@ if pn_search and not pn_data.empty:
 
     st.plotly_chart(fig_pn_bar, use_container_width=True)
 
+# -------------------------------
+# ⏳ P/N 取り外し間隔（MTBUR）ランキングと部品別の詳細
+# -------------------------------
+st.subheader("⏳ P/N Removal Intervals (MTBUR)")
+
+pn_removals = build_pn_removal_index(df, df_fc, DATA_VERSION)
+
+min_intervals = st.slider("ランキング対象の最小間隔数", min_value=1, max_value=10, value=3, key="pn_min_intervals")
+pn_ranking = pn_removals["ranking"]
+pn_ranking = pn_ranking[pn_ranking["Intervals"] >= min_intervals].reset_index(drop=True)
+
+st.markdown("🔢 **平均取り外し間隔が短い P/N（上位20）**")
+st.dataframe(
+    pn_ranking.head(20).rename(columns={
+        'Removals': '交換件数',
+        'Tails': '機番数',
+        'Intervals': '間隔数',
+        'MTBUR_Days': '平均間隔(日)',
+        'Median_Days': '中央値(日)',
+        'Min_Days': '最短(日)',
+        'MTBUR_FC': '平均間隔(FC)',
+        'Last_Date': '最終交換日'
+    }).round(1),
+    use_container_width=True,
+    hide_index=True
+)
+
+# 検索中の P/N があれば既定で選択
+pn_options = pn_ranking["PN"].tolist()
+pn_default = next((i for i, pn in enumerate(pn_options) if pn_search and pn_search.lower() in pn.lower()), 0)
+selected_pn = st.selectbox("P/N 詳細", pn_options, index=pn_default, key="pn_interval_select")
+
+if selected_pn is not None:
+    pn_rows = lookup_pn_removals(pn_removals, selected_pn)
+
+    def build_pn_interval_chart():
+        intervals = pn_rows.dropna(subset=["Interval_Days"])
+        fig_pn_interval = px.strip(
+            intervals,
+            x="Tail",
+            y="Interval_Days",
+            hover_data=["Reported_Date", "Interval_FC"],
+            title=f"P/N: {selected_pn} 機番別 取り外し間隔（日）"
+        )
+        fig_pn_interval.add_hline(
+            y=intervals["Interval_Days"].mean(), line_dash="dash", line_color="orange",
+            annotation_text="平均"
+        )
+        fig_pn_interval.update_layout(
+            xaxis=dict(type="category", title="機番"),
+            yaxis_title="前回交換からの日数",
+            margin=dict(t=50)
+        )
+        return fig_pn_interval
+
+    fig_pn_interval = cached_figure("pn_interval", (selected_pn,), build_pn_interval_chart)
+    st.plotly_chart(fig_pn_interval, use_container_width=True)
+
+    pn_rows_display = pn_rows[['Tail', 'Reported_Date', 'Interval_Days', 'Interval_FC', 'MOD_Description']].copy()
+    pn_rows_display['Reported_Date'] = pn_rows_display['Reported_Date'].dt.strftime('%Y-%m-%d')
+    st.dataframe(
+        pn_rows_display.rename(columns={
+            'Reported_Date': '交換日',
+            'Interval_Days': '間隔(日)',
+            'Interval_FC': '間隔(FC)'
+        }).round(1),
+        use_container_width=True,
+        hide_index=True
+    )
+
+
+
+# -------------------------------
+# 🧮 SQL 分析（defects / irregular / fc）
+# -------------------------------
+st.header("🧮 SQL 分析")
+
+
+with st.expander("テーブルと列"):
+    for table in HISTORY_TABLES:
+        columns = run_sql(f"SELECT * FROM {table} LIMIT 0", history_paths, DATA_VERSION).columns
+        st.markdown(f"**{table}**: " + ", ".join(columns))
+
+sql_query = st.text_area(
+    "SQL（SELECT / WITH のみ）",
+    value=(
+        "SELECT Branch, COUNT(*) AS Events, SUM(TRY_CAST(Delay_Time AS DOUBLE)) AS Delay_Minutes\n"
+        "FROM irregular\n"
+        "WHERE ATA_Chapter = '21' AND Date >= (SELECT MAX(Date) FROM irregular) - INTERVAL 3 MONTH\n"
+        "GROUP BY Branch\n"
+        "ORDER BY Delay_Minutes DESC"
+    ),
+    height=160
+)
+
+if st.button("実行", key="run_sql"):
+    try:
+        start = time.perf_counter()
+        sql_result = run_sql(sql_query, history_paths, DATA_VERSION)
+        elapsed = time.perf_counter() - start
+        st.markdown(f"🔢 **{len(sql_result)} 行**（{elapsed:.2f} 秒）")
+        st.dataframe(sql_result, use_container_width=True, hide_index=True)
+    except Exception as e:
+        st.error(f"SQLエラー: {e}")
+
+# -------------------------------
+# 🧾 取り込み除外（スキーマに合わない行・値）
+# -------------------------------
+quarantine = pd.concat([defect_quarantine, irregular_quarantine, fc_quarantine], ignore_index=True)
+quarantine_rows = quarantine[quarantine["Action"] != "欠損として取り込み"].drop_duplicates(["Source", "Row"])
+
+with st.expander(f"🧾 取り込み除外（Quarantine）：除外 {len(quarantine_rows):,} 行 / 記録 {len(quarantine):,} 件"):
+    quarantine_summary = (
+        quarantine.groupby(["Source", "Column", "Reason", "Action"])
+        .size()
+        .reset_index(name="Count")
+        .sort_values("Count", ascending=False)
+    )
+    st.dataframe(quarantine_summary, use_container_width=True, hide_index=True)
+    st.dataframe(quarantine, use_container_width=True, hide_index=True, height=300)
+
+
+# -------------------------------
+# COA ステータス スナップショット
+# -------------------------------
+# D_AC_350 バリアントテーブルを一括で取り込み、COA番号で索引を作る
+# （SAP GUI がない環境では同じ形式のファイルを代わりに使う）
+COA_VARIANT_TABLE = "D_AC_350"
+COA_SNAPSHOT_FILE = "D_AC_350.csv"
+COA_CODE_PATTERN = r"(COA\w{7}ER0\w)"
+COA_SHIPS = [
+    "JA01XJ", "JA02XJ", "JA03XJ", "JA04XJ", "JA05XJ", "JA06XJ", "JA07XJ",
+    "JA08XJ", "JA09XJ", "JA10XJ", "JA11XJ", "JA12XJ", "JA14XJ", "JA15XJ", "JA16XJ",
+    "JA17XJ", "JA18XJ", "JA19XJ", "JA01WJ", "JA02WJ", "JA03WJ", "JA04WJ", "JA05WJ",
+    "JA06WJ", "JA07WJ", "JA08WJ", "JA09WJ", "JA10WJ", "JA11WJ", "JA12WJ", "JA13WJ"
+]
+
+def fetch_coa_snapshot_from_sap(snapshot_path=COA_SNAPSHOT_FILE):
+    import win32com.client
+
+    # SAP接続処理（Windows環境限定）
+    SapGuiAuto = win32com.client.GetObject("SAPGUI")
+    application = SapGuiAuto.GetScriptingEngine
+    connection = application.Children(0)
+    session = connection.Children(0)
+
+    session.findById("wnd[0]/tbar[0]/okcd").Text = "/NZDMPM_VAR_TAB_DISP"
+    session.findById("wnd[0]/tbar[0]/btn[0]").press()
+
+    session.findById("wnd[0]/usr/radP_RBVT").Select()
+    session.findById("wnd[0]/usr/ctxtP_VTAB").Text = COA_VARIANT_TABLE
+    session.findById("wnd[0]/usr/radP_RBCVD").Select()
+    session.findById("wnd[0]/tbar[1]/btn[8]").press()
+
+    alv = session.findById("wnd[0]/usr/cntlCONTAINER_ALV/shellcont/shell")
+    columns = [alv.ColumnOrder.ElementAt(i) for i in range(alv.ColumnOrder.Count)]
+
+    # セル単位の GetCellValue ではなく ALV の「ローカルファイル → 表計算」で一括出力
+    export_dir, export_name = os.path.split(os.path.abspath(snapshot_path + ".txt"))
+    alv.pressToolbarContextButton("&MB_EXPORT")
+    alv.selectContextMenuItem("&PC")
+    session.findById(
+        "wnd[1]/usr/subSUBSCREEN_STEPLOOP:SAPLSPO5:0150/sub:SAPLSPO5:0150/radSPOPLI-SELFLAG[1,0]"
+    ).Select()
+    session.findById("wnd[1]/tbar[0]/btn[0]").press()
+    session.findById("wnd[1]/usr/ctxtDY_PATH").Text = export_dir
+    session.findById("wnd[1]/usr/ctxtDY_FILENAME").Text = export_name
+    session.findById("wnd[1]/usr/ctxtDY_FILE_ENCODING").Text = "4110"  # UTF-8
+    session.findById("wnd[1]/tbar[0]/btn[11]").press()
+
+    export_path = os.path.join(export_dir, export_name)
+    raw = pd.read_csv(export_path, sep="\t", header=None, skiprows=1, dtype=str, encoding="utf-8")
+    os.remove(export_path)
+
+    # 表計算形式は先頭に空列が付くことがあるため、右端から列名を当てる
+    raw = raw.iloc[:, -len(columns):]
+    raw.columns = columns
+    snapshot = raw[["CHARS"] + [s for s in COA_SHIPS if s in raw.columns]].fillna("")
+    snapshot.to_csv(snapshot_path, index=False, encoding="utf-8")
+    return snapshot
+
+def load_coa_snapshot_from_file(snapshot_path=COA_SNAPSHOT_FILE):
+    return pd.read_csv(snapshot_path, dtype=str, encoding="utf-8").fillna("")
+
+# スナップショットの取得（更新）は SAP GUI のある Windows 環境でのみ可能
+def sap_gui_available():
+    return platform.system() == "Windows"
+
+@st.cache_data
+def build_coa_index(snapshot_mtime):
+    snapshot = load_coa_snapshot_from_file()
+    ships = [s for s in COA_SHIPS if s in snapshot.columns]
+
+    # CHARS 内の COA番号ごとに行を展開し、機番ごとのステータスに縦持ち化
+    snapshot["COA"] = snapshot["CHARS"].str.findall(COA_CODE_PATTERN)
+    status = (
+        snapshot.explode("COA")
+        .dropna(subset=["COA"])
+        .melt(id_vars="COA", value_vars=ships, var_name="Ship", value_name="Status")
+    )
+    # 同じ COA番号が1つの CHARS に複数回、または複数行に現れても機番は1回だけ数える
+    df_post_all = status[status["Status"] == "C"].drop_duplicates(["COA", "Ship"])
 
+    # COA番号 → POST状態（C）の機番一覧
+    return {
+        code: group[["Ship", "Status"]].reset_index(drop=True)
+        for code, group in df_post_all.groupby("COA", sort=False)
+    }
 
 # -------------------------------
 # ① 入力フォーム
@@ -1053,128 +3156,41 @@ full_coa_code = f"COA{coa_xx}{coa_yyyyy}ER0{coa_z}"
 # -------------------------------
 # ② 検索ボタン
 # -------------------------------
-if st.button("検索"):
+col_search, col_refresh = st.columns([1, 5])
+with col_search:
+    coa_search_clicked = st.button("検索")
+with col_refresh:
+    coa_refresh_clicked = st.button("スナップショット更新", disabled=not sap_gui_available())
+if not sap_gui_available():
+    st.info(f"SAP GUI がない環境のため、スナップショットは更新できません（{COA_SNAPSHOT_FILE} を参照します）。")
+
+if coa_refresh_clicked:
+    try:
+        fetch_coa_snapshot_from_sap()
+        build_coa_index.clear()
+        st.success(f"{COA_VARIANT_TABLE} のスナップショットを更新しました。")
+    except Exception as e:
+        st.error(f"スナップショット更新エラー: {e}")
+
+if coa_search_clicked:
     if len(coa_xx) == 2 and len(coa_yyyyy) == 5 and len(coa_z) == 1:
-        if platform.system() == "Windows":
-            try:
-                # SAP接続処理（Windows環境限定）
-                SapGuiAuto = win32com.client.GetObject("SAPGUI")
-                application = SapGuiAuto.GetScriptingEngine
-                connection = application.Children(0)
-                session = connection.Children(0)
-
-                session.findById("wnd[0]/tbar[0]/okcd").Text = "/NZDMPM_VAR_TAB_DISP"
-                session.findById("wnd[0]/tbar[0]/btn[0]").press()
-
-                session.findById("wnd[0]/usr/radP_RBVT").Select()
-                session.findById("wnd[0]/usr/ctxtP_VTAB").Text = "D_AC_350"
-                session.findById("wnd[0]/usr/radP_RBCVD").Select()
-                session.findById("wnd[0]/tbar[1]/btn[8]").press()
-
-                alv = session.findById("wnd[0]/usr/cntlCONTAINER_ALV/shellcont/shell")
-                row_count = alv.RowCount
-
-                result = []
-                for i in range(row_count):
-                    chara = alv.GetCellValue(i, "CHARS")
-                    if full_coa_code in chara:
-                        for ship in [
-                            "JA01XJ", "JA02XJ", "JA03XJ", "JA04XJ", "JA05XJ", "JA06XJ", "JA07XJ",
-                            "JA08XJ", "JA09XJ", "JA10XJ", "JA11XJ", "JA12XJ", "JA14XJ", "JA15XJ", "JA16XJ",
-                            "JA17XJ", "JA18XJ", "JA19XJ", "JA01WJ", "JA02WJ", "JA03WJ", "JA04WJ", "JA05WJ",
-                            "JA06WJ", "JA07WJ", "JA08WJ", "JA09WJ", "JA10WJ", "JA11WJ", "JA12WJ", "JA13WJ"
-                        ]:
-                            try:
-                                status = alv.GetCellValue(i, ship)
-                                result.append({'Ship': ship, 'Status': status})
-                            except:
-                                continue
-
-                df_result = pd.DataFrame(result)
-                df_post = df_result[df_result['Status'] == 'C']
-                post_count = df_post.shape[0]
-
-                st.success(f"{full_coa_code} のPOST状態（C）の機番数： {post_count} 機")
-                st.dataframe(df_post)
-
-            except Exception as e:
-                st.error(f"SAPアクセスエラー: {e}")
-        else:
-            st.warning("この機能はWindows環境（SAP GUIがインストールされている環境）でのみ利用できます。")
-    else:
-        st.warning("すべての入力欄（XX・YYYYY・Z）を正しく入力してください。")
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
+        try:
+            # スナップショットが無ければ一度だけ取得
+            if not os.path.exists(COA_SNAPSHOT_FILE):
+                if not sap_gui_available():
+                    raise FileNotFoundError(
+                        f"{COA_SNAPSHOT_FILE} がありません（SAP GUI 環境で取得したファイルを配置してください）"
+                    )
+                fetch_coa_snapshot_from_sap()
 
+            coa_index = build_coa_index(os.path.getmtime(COA_SNAPSHOT_FILE))
+            df_post = coa_index.get(full_coa_code, pd.DataFrame(columns=["Ship", "Status"]))
+            post_count = df_post.shape[0]
 
+            st.success(f"{full_coa_code} のPOST状態（C）の機番数： {post_count} 機")
+            st.dataframe(df_post)
 
+        except Exception as e:
+            st.error(f"COAステータス取得エラー: {e}")
+    else:
+        st.warning("すべての入力欄（XX・YYYYY・Z）を正しく入力してください。")
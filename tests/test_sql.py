@@ -0,0 +1,50 @@
+import ast
+import os
+
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pytest
+
+SCRIPT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "a350_dashboard.py")
+
+
+# ダッシュボードはスクリプト実行（import すると画面描画まで走る）のため、対象の関数だけを取り出す
+def load_functions(*names, **namespace):
+    with open(SCRIPT, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    body = [node for node in tree.body if isinstance(node, ast.FunctionDef) and node.name in names]
+    exec(compile(ast.Module(body=body, type_ignores=[]), SCRIPT, "exec"), namespace)
+    return namespace
+
+
+@pytest.fixture
+def run_sql():
+    datasets = {"defects": ds.dataset(pa.table({"ATA_Chapter": ["21", "21", "36"]}))}
+    namespace = load_functions(
+        "check_sql_query", "run_sql", get_history_datasets=lambda paths, data_version: datasets
+    )
+    return lambda query: namespace["run_sql"](query, {}, "test")
+
+
+def test_select_runs(run_sql):
+    result = run_sql("WITH t AS (SELECT ATA_Chapter FROM defects) SELECT COUNT(*) AS n FROM t WHERE ATA_Chapter = '21'")
+    assert result["n"].tolist() == [2]
+
+
+def test_multiple_statements_rejected(run_sql, tmp_path):
+    target = tmp_path / "x.csv"
+    with pytest.raises(ValueError):
+        run_sql(f"SELECT 1; COPY (SELECT 42 AS x) TO '{target}'")
+    assert not target.exists()
+
+
+def test_file_access_rejected(run_sql, tmp_path):
+    source = tmp_path / "secret.csv"
+    source.write_text("a\n1\n")
+    with pytest.raises(Exception, match="disabled by configuration"):
+        run_sql(f"SELECT * FROM read_csv('{source}')")
+
+
+def test_configuration_locked(run_sql):
+    with pytest.raises(ValueError):
+        run_sql("SET enable_external_access=true")